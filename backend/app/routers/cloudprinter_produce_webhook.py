@@ -169,7 +169,7 @@ async def cloudprinter_itemproduce_webhook(
     data = ItemProducePayload(**payload)
 
     try:
-        from main import orders_collection
+        from main import orders_collection, invalidate_orders_count_cache, stamp_order_keys, enqueue_label_prefetch
     except Exception as e:
         print(f"[CP PRODUCE] DB import error: {e}")
         raise HTTPException(status_code=500, detail="Server misconfiguration")
@@ -182,11 +182,16 @@ async def cloudprinter_itemproduce_webhook(
         "cp_item_reference": data.item_reference,
     }
     res = orders_collection.update_one({"order_id": data.order_reference}, {"$set": update_fields})
+    stamp_order_keys({"order_id": data.order_reference})
+    invalidate_orders_count_cache()
 
     if res.matched_count == 0:
         print(f"[CP PRODUCE] order not found for order_ref={data.order_reference} -> 204")
         return Response(status_code=204)
 
+    # warm the Shiprocket label while the book is being printed
+    enqueue_label_prefetch(data.order_reference)
+
     # Idempotent email gate
     once = orders_collection.update_one(
         {"order_id": data.order_reference, "$or": [{"production_email_sent": {"$exists": False}}, {"production_email_sent": False}]},
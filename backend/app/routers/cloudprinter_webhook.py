@@ -250,7 +250,7 @@ async def cloudprinter_webhook(
     # ---- DB work + idempotent email
     try:
         # Lazy import to avoid circular import with main.py
-        from main import orders_collection
+        from main import orders_collection, invalidate_orders_count_cache, stamp_order_keys
     except Exception as e:
         print(f"[CP WEBHOOK] DB import error: {e}")
         raise HTTPException(status_code=500, detail="Server misconfiguration")
@@ -264,6 +264,8 @@ async def cloudprinter_webhook(
     }
     orders_collection.update_one({"order_id": data.order_reference}, {
                                  "$set": update_fields})
+    stamp_order_keys({"order_id": data.order_reference})
+    invalidate_orders_count_cache()
 
     # 2) Idempotent email: set shipped_email_sent=True only once; send email iff we flipped it now
     filter_once = {
@@ -1,12 +1,14 @@
 # app/routers/razorpay_export.py
-import os, io, csv, re
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import os, io, csv, re, time, asyncio, itertools, heapq
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
 import httpx
 from fastapi import APIRouter, Query, HTTPException, Body
 from fastapi.responses import StreamingResponse
 from dateutil import parser as dtparser
 from dotenv import load_dotenv
+from pymongo import MongoClient, ReplaceOne
 
 router = APIRouter(prefix="/razorpay", tags=["razorpay"])
 
@@ -42,50 +44,666 @@ def ts_to_ddmmyyyy_hhmmss(ts: Any) -> str:
     except Exception:
         return ""
 
-async def fetch_payments(
+# ---- windowed, concurrent /payments fetcher --------------------------------
+# /v1/payments pages are capped at 100 and `skip` is serial, so the [from, to]
+# range is cut into time slices fetched concurrently. A slice whose first page
+# comes back full keeps that page (newest 100, Razorpay returns created_at DESC)
+# and re-queues the older remainder split in two, so busy periods subdivide
+# until each slice fits a page while empty ones cost a single call. Adjacent
+# slices share their boundary second; results are de-duplicated by id.
+RZP_PAGE = 100  # Razorpay max per call
+RZP_FETCH_CONCURRENCY = int(os.getenv("RAZORPAY_FETCH_CONCURRENCY", "6"))
+RZP_RATE_PER_SEC = float(os.getenv("RAZORPAY_RATE_PER_SEC", "10"))
+RZP_MAX_ATTEMPTS = int(os.getenv("RAZORPAY_MAX_ATTEMPTS", "5"))
+RZP_INITIAL_SLICES = int(os.getenv("RAZORPAY_INITIAL_SLICES", "24"))
+# lower bound used when no from date is given ("all time")
+RZP_EPOCH = int(os.getenv("RAZORPAY_FETCH_EPOCH", "1420070400"))  # 2015-01-01
+
+
+class _RateLimiter:
+    """Token bucket shared by the concurrent slice fetchers of one call."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.burst = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def _rzp_get(client: httpx.AsyncClient, limiter: _RateLimiter, path: str,
+                   params: Optional[Dict[str, Any]] = None) -> httpx.Response:
+    """GET with rate limiting; retries 429/5xx/network errors with backoff."""
+    for attempt in range(RZP_MAX_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            r = await client.get(f"{RZP_BASE}{path}", params=params)
+        except httpx.RequestError:
+            if attempt == RZP_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(8, 2 ** attempt))
+            continue
+        if r.status_code == 429 or r.status_code >= 500:
+            if attempt == RZP_MAX_ATTEMPTS - 1:
+                return r
+            ra = r.headers.get("Retry-After")
+            await asyncio.sleep(float(ra) if ra and ra.isdigit() else min(8, 2 ** attempt))
+            continue
+        return r
+    return r
+
+
+async def fetch_payments_remote(
     client: httpx.AsyncClient,
     *,
     status_filter: Optional[str],
     from_unix: Optional[int],
     to_unix: Optional[int],
     max_fetch: int = 10000,
+    concurrency: int = RZP_FETCH_CONCURRENCY,
 ) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
-    skip = 0
-    COUNT = 100  # Razorpay max per call
+    """
+    Payments in [from_unix, to_unix] straight from Razorpay, newest first (created_at DESC), at most
+    `max_fetch` after the optional status filter.
 
-    while True:
-        params: Dict[str, Any] = {"count": COUNT, "skip": skip}
-        if from_unix is not None: params["from"] = from_unix
-        if to_unix is not None:   params["to"]   = to_unix
+    Slices are processed newest-first. Once `max_fetch` matching payments are
+    in hand, the created_at of the oldest of them is a cutoff: slices entirely
+    older than it cannot contain any of the newest `max_fetch` and are skipped,
+    while newer ones (possibly still being split) are fetched to the end, so a
+    capped result has no gaps.
+    """
+    lo = from_unix if from_unix is not None else RZP_EPOCH
+    hi = to_unix if to_unix is not None else int(time.time())
+    if hi < lo:
+        return []
+    sf = status_filter.lower() if status_filter else None
 
+    # priority queue of (-slice_hi, slice_lo, skip): newest slice first
+    step = max(1, (hi - lo + 1) // max(1, RZP_INITIAL_SLICES))
+    queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    start = lo
+    while start <= hi:
+        end = min(hi, start + step)
+        queue.put_nowait((-end, start, 0))
+        start = end + 1
+
+    by_id: Dict[str, Dict[str, Any]] = {}
+    # created_at of the newest `max_fetch` matches, smallest on top
+    newest: List[int] = []
+    limiter = _RateLimiter(RZP_RATE_PER_SEC, burst=max(1, concurrency))
+    idle = asyncio.Event()
+    active = 0
+
+    def _cutoff() -> Optional[int]:
+        return newest[0] if max_fetch > 0 and len(newest) >= max_fetch else None
+
+    async def _fetch_slice(s_lo: int, s_hi: int, skip: int) -> None:
+        params: Dict[str, Any] = {"count": RZP_PAGE, "skip": skip, "from": s_lo, "to": s_hi}
         # include UPI/card context where available
         params["expand[]"] = "card"
-
-        r = await client.get(f"{RZP_BASE}/payments", params=params)
+        r = await _rzp_get(client, limiter, "/payments", params)
         r.raise_for_status()
-        data = r.json()
-        batch = data.get("items", []) or []
-        if status_filter:
-            sf = status_filter.lower()
-            batch = [p for p in batch if (p.get("status") or "").lower() == sf]
-        items.extend(batch)
+        batch = r.json().get("items", []) or []
 
-        if len(batch) < COUNT or len(items) >= max_fetch:
-            break
-        skip += COUNT
+        for p in batch:
+            pid = p.get("id")
+            if pid and pid not in by_id:
+                by_id[pid] = p
+                if not sf or (p.get("status") or "").lower() == sf:
+                    ts = int(p.get("created_at") or 0)
+                    if len(newest) < max_fetch:
+                        heapq.heappush(newest, ts)
+                    elif ts > newest[0]:
+                        heapq.heapreplace(newest, ts)
 
+        if len(batch) < RZP_PAGE:
+            return
+        oldest = min(int(p.get("created_at") or s_hi) for p in batch)
+        if skip or oldest >= s_hi:
+            # a full page inside one second: only skip can make progress
+            queue.put_nowait((-s_hi, s_lo, skip + RZP_PAGE))
+        elif oldest - s_lo < 2:
+            queue.put_nowait((-oldest, s_lo, 0))
+        else:
+            mid = (s_lo + oldest) // 2
+            queue.put_nowait((-oldest, mid, 0))
+            queue.put_nowait((-mid, s_lo, 0))
+
+    async def _worker() -> None:
+        nonlocal active
+        while True:
+            try:
+                neg_hi, s_lo, skip = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if active == 0:
+                    return
+                idle.clear()
+                await idle.wait()
+                continue
+            cutoff = _cutoff()
+            if cutoff is not None and -neg_hi < cutoff:
+                # newest slice left is older than the cutoff, and so is the rest
+                return
+            active += 1
+            try:
+                await _fetch_slice(s_lo, -neg_hi, skip)
+            finally:
+                active -= 1
+                idle.set()
+
+    workers = [asyncio.create_task(_worker()) for _ in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+
+    items = [p for p in by_id.values() if not sf or (p.get("status") or "").lower() == sf]
+    items.sort(key=lambda p: (int(p.get("created_at") or 0), p.get("id") or ""), reverse=True)
     return items[:max_fetch]
 
+
+# ---- local payment mirror (Mongo: razorpay_payments) ------------------------
+# Historical payments rarely change, so fetch_payments reads them from a local
+# mirror kept fresh by an incremental sync: each sync re-fetches from the
+# high-water mark (max created_at seen) minus RAZORPAY_MIRROR_OVERLAP_SECONDS
+# to pick up late status changes, and at most every RAZORPAY_MIRROR_DEEP_EVERY
+# seconds a deep sync re-fetches a longer window (refunds, late captures).
+# The backfill and deep syncs run in a background task started with the app;
+# requests only top up the delta, never wait on a sync already running, and
+# on a Razorpay error serve the mirror flagged stale. When a request's sync is
+# skipped (min-sync window, or a sync already running) the payments created
+# since the last sync are fetched live, up to
+# RAZORPAY_MIRROR_LIVE_TOP_UP_MAX_SECONDS of them; a longer gap is served
+# flagged stale. Until the first backfill completes, requests go straight to
+# Razorpay.
+# Without MONGO_URI the mirror is disabled and every call goes to Razorpay.
+MONGO_URI = os.getenv("MONGO_URI")
+MIRROR_OVERLAP_SECONDS = int(os.getenv("RAZORPAY_MIRROR_OVERLAP_SECONDS", "3600"))
+MIRROR_MIN_SYNC_SECONDS = float(os.getenv("RAZORPAY_MIRROR_MIN_SYNC_SECONDS", "60"))
+MIRROR_DEEP_OVERLAP_SECONDS = int(os.getenv("RAZORPAY_MIRROR_DEEP_OVERLAP_SECONDS", str(7 * 86400)))
+MIRROR_DEEP_EVERY_SECONDS = float(os.getenv("RAZORPAY_MIRROR_DEEP_EVERY_SECONDS", str(6 * 3600)))
+MIRROR_LIVE_TOP_UP_MAX_SECONDS = int(os.getenv("RAZORPAY_MIRROR_LIVE_TOP_UP_MAX_SECONDS", "900"))
+MIRROR_STATE_ID = "payments"
+
+_mirror_db = None
+_mirror_lock = asyncio.Lock()
+_mirror_task: Optional[asyncio.Task] = None
+
+
+def _mirror():
+    """
+    razorpay_payments / razorpay_sync_state collections, or None if disabled.
+    Blocking on first use (client + indexes): call from a thread, or
+    _mirror_db_async() from async code.
+    """
+    global _mirror_db
+    if _mirror_db is None and MONGO_URI:
+        db = MongoClient(MONGO_URI, tz_aware=True)["candyman"]
+        db["razorpay_payments"].create_index([("created_at", -1)], name="created_at")
+        db["razorpay_payments"].create_index([("status", 1), ("created_at", -1)], name="status_created_at")
+        _mirror_db = db
+    return _mirror_db
+
+
+async def _mirror_db_async():
+    if _mirror_db is not None or not MONGO_URI:
+        return _mirror_db
+    return await asyncio.to_thread(_mirror)
+
+
+def _mirror_state() -> Dict[str, Any]:
+    return _mirror()["razorpay_sync_state"].find_one({"_id": MIRROR_STATE_ID}) or {}
+
+
+def upsert_mirrored_payments(payments: List[Dict[str, Any]]) -> int:
+    db = _mirror()
+    if db is None or not payments:
+        return 0
+    now = datetime.now(timezone.utc)
+    ops = [
+        ReplaceOne({"_id": p["id"]}, {**p, "_id": p["id"], "_synced_at": now}, upsert=True)
+        for p in payments if p.get("id")
+    ]
+    if ops:
+        db["razorpay_payments"].bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def _strip_mirror_fields(doc: Dict[str, Any]) -> Dict[str, Any]:
+    doc.pop("_id", None)
+    doc.pop("_synced_at", None)
+    return doc
+
+
+def get_mirrored_payments(ids: List[str], max_age: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    {id: payment} for the ids present in the mirror (empty if disabled),
+    only those synced within `max_age` seconds if given.
+    """
+    db = _mirror()
+    if db is None or not ids:
+        return {}
+    query: Dict[str, Any] = {"_id": {"$in": list(ids)}}
+    if max_age is not None:
+        query["_synced_at"] = {"$gte": datetime.now(timezone.utc) - timedelta(seconds=max_age)}
+    return {doc["_id"]: _strip_mirror_fields(doc) for doc in db["razorpay_payments"].find(query)}
+
+
+async def sync_payments_mirror(client: httpx.AsyncClient, *, force: bool = False,
+                               deep: bool = False, delta_only: bool = False) -> Dict[str, Any]:
+    """
+    Fetch the delta since the high-water mark into the mirror. Concurrent
+    callers share one sync; calls within RAZORPAY_MIRROR_MIN_SYNC_SECONDS of
+    the last one are no-ops unless forced.
+
+    `delta_only` is the request-path mode: it returns at once if a sync is
+    already running, and never backfills or deep-syncs (the background task
+    does); "ready" is False until the first backfill has completed.
+    """
+    if await _mirror_db_async() is None:
+        return {"enabled": False}
+    if delta_only and _mirror_lock.locked():
+        # a background sync is running; serve what is there if backfilled
+        state = await asyncio.to_thread(_mirror_state)
+        return {"enabled": True, "skipped": True, "busy": True,
+                "ready": state.get("high_water") is not None, **_public_state(state)}
+
+    async with _mirror_lock:
+        state = await asyncio.to_thread(_mirror_state)
+        now = time.time()
+        high_water = state.get("high_water")
+        last = state.get("synced_at_unix") or 0
+        if delta_only and high_water is None:
+            return {"enabled": True, "skipped": True, "ready": False, **_public_state(state)}
+        if not force and not deep and now - last < MIRROR_MIN_SYNC_SECONDS:
+            return {"enabled": True, "skipped": True, "ready": True, **_public_state(state)}
+
+        if not delta_only:
+            deep = deep or now - (state.get("deep_synced_at_unix") or 0) >= MIRROR_DEEP_EVERY_SECONDS
+        if high_water is None:
+            from_unix = RZP_EPOCH  # first run: full backfill
+        else:
+            from_unix = high_water - (MIRROR_DEEP_OVERLAP_SECONDS if deep else MIRROR_OVERLAP_SECONDS)
+
+        t0 = time.perf_counter()
+        payments = await fetch_payments_remote(
+            client, status_filter=None, from_unix=from_unix, to_unix=int(now), max_fetch=10**9,
+        )
+        upserted = await asyncio.to_thread(upsert_mirrored_payments, payments)
+
+        newest = max((int(p.get("created_at") or 0) for p in payments), default=0)
+        fields: Dict[str, Any] = {
+            "high_water": max(high_water or 0, newest) or None,
+            "synced_at_unix": int(now),
+            "last_sync_fetched": len(payments),
+            "last_sync_seconds": round(time.perf_counter() - t0, 3),
+        }
+        if deep or high_water is None:
+            fields["deep_synced_at_unix"] = int(now)
+        await asyncio.to_thread(
+            _mirror()["razorpay_sync_state"].update_one,
+            {"_id": MIRROR_STATE_ID}, {"$set": fields}, upsert=True,
+        )
+        state.update(fields)
+        return {"enabled": True, "skipped": False, "ready": True, "deep": deep, "upserted": upserted,
+                **_public_state(state)}
+
+
+async def _mirror_sync_loop() -> None:
+    # backfill on first run, then deltas (and periodic deep syncs) off the request path
+    async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=60.0) as client:
+        while True:
+            try:
+                res = await sync_payments_mirror(client)
+                if not res.get("skipped"):
+                    print(f"[RZP MIRROR] synced {res.get('upserted', 0)} payments"
+                          f"{' (deep)' if res.get('deep') else ''} in {res.get('last_sync_seconds')}s")
+            except Exception as e:
+                print(f"[RZP MIRROR] sync error: {e}")
+            await asyncio.sleep(MIRROR_MIN_SYNC_SECONDS)
+
+
+@router.on_event("startup")
+async def _start_payments_mirror() -> None:
+    global _mirror_task
+    if not MONGO_URI or not KEY_ID or not KEY_SECRET:
+        return
+    await asyncio.to_thread(_mirror)
+    _mirror_task = asyncio.create_task(_mirror_sync_loop())
+
+
+@router.on_event("shutdown")
+async def _stop_payments_mirror() -> None:
+    if _mirror_task is not None:
+        _mirror_task.cancel()
+
+
+async def _live_top_up(client: httpx.AsyncClient, synced_at: Optional[int],
+                       from_unix: Optional[int], to_unix: Optional[int]) -> Dict[str, Any]:
+    """
+    Cover the requested range past the last sync when the request-path sync
+    was skipped: the gap is fetched from Razorpay into the mirror if it spans
+    at most RAZORPAY_MIRROR_LIVE_TOP_UP_MAX_SECONDS, otherwise reported stale.
+    """
+    now = int(time.time())
+    want = min(to_unix, now) if to_unix is not None else now
+    if synced_at is None or want <= synced_at:
+        return {"synced_at_unix": synced_at}
+    lag = want - synced_at
+    if lag > MIRROR_LIVE_TOP_UP_MAX_SECONDS:
+        return {"stale": True, "lag_seconds": lag, "synced_at_unix": synced_at}
+    payments = await fetch_payments_remote(
+        client, status_filter=None, from_unix=max(synced_at, from_unix or 0), to_unix=want, max_fetch=10**9,
+    )
+    await asyncio.to_thread(upsert_mirrored_payments, payments)
+    return {"live_top_up": len(payments), "synced_at_unix": synced_at}
+
+
+async def _top_up_mirror(client: httpx.AsyncClient, meta: Optional[Dict[str, Any]],
+                         from_unix: Optional[int] = None, to_unix: Optional[int] = None) -> bool:
+    """
+    Request-path delta sync for [from_unix, to_unix]. True if the mirror can
+    serve the request; a Razorpay error is logged and the mirror served as is,
+    flagged stale in `meta`, as is a gap since the last sync too long to top up.
+    """
+    if await _mirror_db_async() is None:
+        return False
+    info: Dict[str, Any] = {"source": "mirror", "stale": False}
+    try:
+        res = await sync_payments_mirror(client, delta_only=True)
+        if not res.get("ready"):
+            return False
+        info["synced_at_unix"] = res.get("synced_at_unix")
+        if res.get("skipped"):
+            info.update(await _live_top_up(client, res.get("synced_at_unix"), from_unix, to_unix))
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"[RZP MIRROR] delta sync failed, serving mirror as is: {e}")
+        state = await asyncio.to_thread(_mirror_state)
+        if state.get("high_water") is None:
+            raise
+        info.update(stale=True, sync_error=str(e)[:300], synced_at_unix=state.get("synced_at_unix"))
+    if meta is not None:
+        meta.update(info)
+    return True
+
+
+def _public_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in state.items() if k != "_id"}
+
+
+def _mirror_query(status_filter: Optional[str], from_unix: Optional[int], to_unix: Optional[int],
+                  max_fetch: int):
+    """Cursor over mirrored payments in [from_unix, to_unix], newest first (created_at DESC)."""
+    query: Dict[str, Any] = {}
+    created: Dict[str, int] = {}
+    if from_unix is not None:
+        created["$gte"] = from_unix
+    if to_unix is not None:
+        created["$lte"] = to_unix
+    if created:
+        query["created_at"] = created
+    if status_filter:
+        query["status"] = status_filter.lower()
+    return _mirror()["razorpay_payments"].find(query).sort([("created_at", -1), ("_id", -1)]).limit(max_fetch)
+
+
+def _read_mirror(status_filter: Optional[str], from_unix: Optional[int], to_unix: Optional[int],
+                 max_fetch: int) -> List[Dict[str, Any]]:
+    return [_strip_mirror_fields(doc) for doc in _mirror_query(status_filter, from_unix, to_unix, max_fetch)]
+
+
+async def fetch_payments(
+    client: httpx.AsyncClient,
+    *,
+    status_filter: Optional[str],
+    from_unix: Optional[int],
+    to_unix: Optional[int],
+    max_fetch: int = 10000,
+    meta: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Payments in [from_unix, to_unix], newest first, at most `max_fetch` after
+    the optional status filter: served from the local mirror after syncing the
+    delta, or straight from Razorpay when the mirror is disabled or not yet
+    backfilled. `meta`, if given, receives the source, the stale flag and
+    the mirror's synced_at_unix.
+    """
+    if await _top_up_mirror(client, meta, from_unix, to_unix):
+        return await asyncio.to_thread(_read_mirror, status_filter, from_unix, to_unix, max_fetch)
+    if meta is not None:
+        meta.update(source="razorpay", stale=False)
+    return await fetch_payments_remote(
+        client, status_filter=status_filter, from_unix=from_unix, to_unix=to_unix, max_fetch=max_fetch,
+    )
+
+
+# ---- payments by id: bounded-concurrency batch fetch + TTL cache -----------
+RZP_BY_ID_CONCURRENCY = int(os.getenv("RAZORPAY_BY_ID_CONCURRENCY", "16"))
+RZP_BY_ID_RATE_PER_SEC = float(os.getenv("RAZORPAY_BY_ID_RATE_PER_SEC", "50"))
+PAYMENT_CACHE_TTL = float(os.getenv("RAZORPAY_PAYMENT_CACHE_TTL", "300"))
+PAYMENT_CACHE_MAX = int(os.getenv("RAZORPAY_PAYMENT_CACHE_MAX", "20000"))
+
+_payment_cache: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+_by_id_limiter: Optional[_RateLimiter] = None
+
+
+def _cached_payment(pid: str) -> Optional[Dict[str, Any]]:
+    hit = _payment_cache.get(pid)
+    if hit is None:
+        return None
+    if time.monotonic() - hit[0] > PAYMENT_CACHE_TTL:
+        _payment_cache.pop(pid, None)
+        return None
+    _payment_cache.move_to_end(pid)
+    return hit[1]
+
+
+def _cache_payment(p: Dict[str, Any]) -> None:
+    _payment_cache[p["id"]] = (time.monotonic(), p)
+    _payment_cache.move_to_end(p["id"])
+    while len(_payment_cache) > PAYMENT_CACHE_MAX:
+        _payment_cache.popitem(last=False)
+
+
+async def fetch_payments_by_ids(
+    client: httpx.AsyncClient,
+    ids: List[str],
+    *,
+    concurrency: int = RZP_BY_ID_CONCURRENCY,
+) -> tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """
+    ({id: payment}, {id: {"status": http status or None, "detail": str}}) for
+    `ids`. Served from the in-memory TTL cache, then mirror rows synced within
+    RAZORPAY_PAYMENT_CACHE_TTL (older ones may predate a refund or capture),
+    then GET /payments/{id} for the rest (bounded concurrency, shared rate limit,
+    429/5xx retried in _rzp_get). Fetched payments are cached and mirrored.
+    """
+    global _by_id_limiter
+    if _by_id_limiter is None:
+        _by_id_limiter = _RateLimiter(RZP_BY_ID_RATE_PER_SEC, burst=RZP_BY_ID_CONCURRENCY)
+
+    found: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, Dict[str, Any]] = {}
+
+    for pid in ids:
+        p = _cached_payment(pid)
+        if p is not None:
+            found[pid] = p
+
+    missing = [pid for pid in ids if pid not in found]
+    if missing:
+        # not re-cached: that would stretch the row's age past the TTL
+        found.update(await asyncio.to_thread(get_mirrored_payments, missing, PAYMENT_CACHE_TTL))
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+    fetched: List[Dict[str, Any]] = []
+
+    async def _one(pid: str) -> None:
+        async with sem:
+            try:
+                r = await _rzp_get(client, _by_id_limiter, f"/payments/{pid}")
+            except httpx.RequestError as e:
+                errors[pid] = {"status": None, "detail": str(e)}
+                return
+        if r.status_code != 200:
+            errors[pid] = {"status": r.status_code, "detail": (r.text or "")[:200]}
+            return
+        try:
+            p = r.json()
+        except ValueError:
+            p = None
+        if not isinstance(p, dict) or not p.get("id"):
+            errors[pid] = {"status": r.status_code, "detail": f"invalid JSON body: {(r.text or '')[:200]}"}
+            return
+        found[pid] = p
+        fetched.append(p)
+        _cache_payment(p)
+
+    await asyncio.gather(*(_one(pid) for pid in ids if pid not in found))
+    if fetched:
+        await asyncio.to_thread(upsert_mirrored_payments, fetched)
+    return found, errors
+
+
+@router.post("/mirror/sync")
+async def mirror_sync(
+    deep: bool = Query(False, description="Re-fetch RAZORPAY_MIRROR_DEEP_OVERLAP_SECONDS behind the high-water mark"),
+) -> Dict[str, Any]:
+    """Force an incremental (or deep) sync of the local payment mirror."""
+    _assert_keys()
+    try:
+        async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=60.0) as client:
+            return await sync_payments_mirror(client, force=True, deep=deep)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Network error calling Razorpay: {e}")
+
+
+CSV_PAGE_ROWS = 500
+
+# Columns tailored to the Razorpay payment JSON
+PAYMENTS_CSV_HEADER = [
+    "id","amount","currency","status","order_id","invoice_id","international","method",
+    "amount_refunded","refund_status","captured","description","card_id","bank","wallet",
+    "vpa","email","contact","notes","fee","tax","error_code","error_description","created_at",
+    "Payments_RRN","Payments_ARN","Auth_code","flow"
+]
+
+
+def _payment_csv_row(p: Dict[str, Any]) -> List[Any]:
+    upi = p.get("upi") or {}
+    acq = p.get("acquirer_data") or {}
+    # VPA may appear in root.vpa or upi.vpa
+    vpa = p.get("vpa") or upi.get("vpa") or ""
+    flow = upi.get("flow", "")
+
+    # Notes can be an object; keep compact JSON-ish string
+    notes = p.get("notes") or ""
+    notes_str = "" if notes == "" else str(notes)
+
+    return [
+        p.get("id",""),
+        amount_to_display(p.get("amount")),
+        p.get("currency",""),
+        p.get("status",""),
+        p.get("order_id",""),
+        p.get("invoice_id",""),
+        str(p.get("international","") if p.get("international") is not None else ""),
+        p.get("method",""),
+        amount_to_display(p.get("amount_refunded")),
+        p.get("refund_status","") if p.get("refund_status") is not None else "",
+        str(p.get("captured","") if p.get("captured") is not None else ""),
+        p.get("description",""),
+        p.get("card_id","") if p.get("card_id") is not None else "",
+        p.get("bank","") if p.get("bank") is not None else "",
+        p.get("wallet","") if p.get("wallet") is not None else "",
+        vpa,
+        p.get("email",""),
+        p.get("contact",""),
+        notes_str,
+        amount_to_display(p.get("fee")),
+        amount_to_display(p.get("tax")),
+        p.get("error_code","") if p.get("error_code") is not None else "",
+        p.get("error_description","") if p.get("error_description") is not None else "",
+        ts_to_ddmmyyyy_hhmmss(p.get("created_at")),
+        acq.get("rrn",""),
+        acq.get("authentication_reference_number",""),
+        acq.get("auth_code",""),
+        flow,
+    ]
+
+
+async def iter_payment_pages(
+    client: httpx.AsyncClient,
+    *,
+    status_filter: Optional[str],
+    from_unix: Optional[int],
+    to_unix: Optional[int],
+    max_fetch: int,
+    meta: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Yield payments newest first, one page at a time, up to `max_fetch`: from
+    a mirror cursor (after syncing the delta) or page by page from Razorpay.
+    `meta` is filled as in fetch_payments before the first page.
+    """
+    sf = status_filter.lower() if status_filter else None
+    sent = 0
+
+    if await _top_up_mirror(client, meta, from_unix, to_unix):
+        cursor = _mirror_query(sf, from_unix, to_unix, max_fetch).batch_size(CSV_PAGE_ROWS)
+        try:
+            while True:
+                page = await asyncio.to_thread(lambda: list(itertools.islice(cursor, CSV_PAGE_ROWS)))
+                if not page:
+                    return
+                yield [_strip_mirror_fields(doc) for doc in page]
+        finally:
+            cursor.close()
+
+    if meta is not None:
+        meta.update(source="razorpay", stale=False)
+    limiter = _RateLimiter(RZP_RATE_PER_SEC, burst=1)
+    skip = 0
+    while sent < max_fetch:
+        params: Dict[str, Any] = {"count": RZP_PAGE, "skip": skip, "expand[]": "card"}
+        if from_unix is not None: params["from"] = from_unix
+        if to_unix is not None:   params["to"]   = to_unix
+        r = await _rzp_get(client, limiter, "/payments", params)
+        r.raise_for_status()
+        batch = r.json().get("items", []) or []
+        page = [p for p in batch if not sf or (p.get("status") or "").lower() == sf][:max_fetch - sent]
+        if page:
+            sent += len(page)
+            yield page
+        if len(batch) < RZP_PAGE:
+            return
+        skip += RZP_PAGE
+
+
 @router.get("/payments-csv")
 async def payments_csv(
     status: Optional[str] = Query("captured", description="Filter by status (e.g. captured)"),
     from_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD or ISO datetime)"),
     to_date: Optional[str]   = Query(None, description="End date (YYYY-MM-DD or ISO datetime)"),
-    max_fetch: int = Query(2000, ge=1, le=50000, description="Upper bound to avoid runaway downloads"),
+    max_fetch: int = Query(2000, ge=1, le=1_000_000, description="Upper bound to avoid runaway downloads"),
 ) -> StreamingResponse:
     """
-    Fetch Razorpay payments and stream as CSV.
+    Fetch Razorpay payments and stream as CSV, one page of rows at a time
+    (memory stays flat whatever max_fetch is).
     Keys must be set in backend env: RAZORPAY_KEY_ID / RAZORPAY_KEY_SECRET
     """
     _assert_keys()
@@ -96,82 +714,58 @@ async def payments_csv(
     from_unix = to_unix(from_date)
     to_unix   = to_unix(to_date)
 
-    try:
+    meta: Dict[str, Any] = {}
+
+    async def _rows() -> AsyncIterator[str]:
+        buf = io.StringIO()
+        w = csv.writer(buf, quoting=csv.QUOTE_MINIMAL)
+        w.writerow(PAYMENTS_CSV_HEADER)
+        yield buf.getvalue()
+
         async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=30.0) as client:
-            payments = await fetch_payments(
+            async for page in iter_payment_pages(
                 client,
                 status_filter=status,
                 from_unix=from_unix,
                 to_unix=to_unix,
                 max_fetch=max_fetch,
-            )
+                meta=meta,
+            ):
+                buf.seek(0)
+                buf.truncate()
+                w.writerows(_payment_csv_row(p) for p in page)
+                yield buf.getvalue()
+
+    # pull the header and the first page before answering, so Razorpay errors
+    # still become a proper HTTP status instead of a truncated download
+    rows = _rows()
+    try:
+        head = [await rows.__anext__()]
+        try:
+            head.append(await rows.__anext__())
+        except StopAsyncIteration:
+            pass
     except httpx.HTTPStatusError as e:
         # bubble up Razorpay error content
         raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
     except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=f"Network error calling Razorpay: {e}")
 
-    # Prepare CSV
-    buf = io.StringIO()
-    w = csv.writer(buf, quoting=csv.QUOTE_MINIMAL)
+    async def _stream() -> AsyncIterator[str]:
+        for chunk in head:
+            yield chunk
+        async for chunk in rows:
+            yield chunk
 
-    # Columns tailored to the JSON you pasted
-    header = [
-        "id","amount","currency","status","order_id","invoice_id","international","method",
-        "amount_refunded","refund_status","captured","description","card_id","bank","wallet",
-        "vpa","email","contact","notes","fee","tax","error_code","error_description","created_at",
-        "Payments_RRN","Payments_ARN","Auth_code","flow"
-    ]
-    w.writerow(header)
-
-    for p in payments:
-        upi = p.get("upi") or {}
-        acq = p.get("acquirer_data") or {}
-        # VPA may appear in root.vpa or upi.vpa
-        vpa = p.get("vpa") or upi.get("vpa") or ""
-        flow = upi.get("flow", "")
-
-        # Notes can be an object; keep compact JSON-ish string
-        notes = p.get("notes") or ""
-        notes_str = "" if notes == "" else str(notes)
-
-        row = [
-            p.get("id",""),
-            amount_to_display(p.get("amount")),
-            p.get("currency",""),
-            p.get("status",""),
-            p.get("order_id",""),
-            p.get("invoice_id",""),
-            str(p.get("international","") if p.get("international") is not None else ""),
-            p.get("method",""),
-            amount_to_display(p.get("amount_refunded")),
-            p.get("refund_status","") if p.get("refund_status") is not None else "",
-            str(p.get("captured","") if p.get("captured") is not None else ""),
-            p.get("description",""),
-            p.get("card_id","") if p.get("card_id") is not None else "",
-            p.get("bank","") if p.get("bank") is not None else "",
-            p.get("wallet","") if p.get("wallet") is not None else "",
-            vpa,
-            p.get("email",""),
-            p.get("contact",""),
-            notes_str,
-            amount_to_display(p.get("fee")),
-            amount_to_display(p.get("tax")),
-            p.get("error_code","") if p.get("error_code") is not None else "",
-            p.get("error_description","") if p.get("error_description") is not None else "",
-            ts_to_ddmmyyyy_hhmmss(p.get("created_at")),
-            acq.get("rrn",""),
-            acq.get("authentication_reference_number",""),
-            acq.get("auth_code",""),
-            flow,
-        ]
-        w.writerow(row)
-
-    buf.seek(0)
     return StreamingResponse(
-        iter([buf.getvalue()]),
+        _stream(),
         media_type="text/csv",
-        headers={"Content-Disposition": 'attachment; filename="razorpay_payments.csv"'}
+        headers={
+            "Content-Disposition": 'attachment; filename="razorpay_payments.csv"',
+            "X-Payments-Source": meta.get("source", ""),
+            "X-Payments-Stale": "1" if meta.get("stale") else "0",
+            "X-Payments-Synced-At": str(meta.get("synced_at_unix") or ""),
+        }
     )
 
 def _extract_job_id(p: Dict[str, Any]) -> Optional[str]:
@@ -242,22 +836,17 @@ async def payments_by_ids(
     items: List[Dict[str, Any]] = []
     errors: List[Dict[str, Any]] = []
 
-    try:
-        async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=20.0) as client:
-            for pid in uniq_ids:
-                try:
-                    r = await client.get(f"{RZP_BASE}/payments/{pid}")
-                    if r.status_code == 404:
-                        errors.append({"id": pid, "error": "Not found"})
-                        continue
-                    r.raise_for_status()
-                    p = r.json()
-                    items.append(_payment_to_detail(p))
-                except httpx.HTTPStatusError as e:
-                    errors.append({"id": pid, "error": f"http {e.response.status_code}", "detail": e.response.text[:200]})
-                except httpx.RequestError as e:
-                    errors.append({"id": pid, "error": "network", "detail": str(e)})
-    except httpx.RequestError as e:
-        raise HTTPException(502, detail=f"Network error calling Razorpay: {e}")
+    async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=20.0) as client:
+        found, failed = await fetch_payments_by_ids(client, uniq_ids)
+
+    for pid in uniq_ids:
+        if pid in found:
+            items.append(_payment_to_detail(found[pid]))
+        elif failed[pid]["status"] == 404:
+            errors.append({"id": pid, "error": "Not found"})
+        elif failed[pid]["status"] is None:
+            errors.append({"id": pid, "error": "network", "detail": failed[pid]["detail"]})
+        else:
+            errors.append({"id": pid, "error": f"http {failed[pid]['status']}", "detail": failed[pid]["detail"]})
 
-    return {"count": len(items), "items": items, "errors": errors}
\ No newline at end of file
+    return {"count": len(items), "items": items, "errors": errors}
@@ -5,7 +5,7 @@ from typing import Optional, Dict, Any, List, Tuple, Union
 import os
 import httpx
 import re
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pymongo.errors import PyMongoError
 from app.routers.razorpay_export import (
     _assert_keys,
@@ -17,6 +17,7 @@ from datetime import timedelta
 from dateutil import parser as dtparser, tz as dttz
 from zoneinfo import ZoneInfo
 import asyncio
+import time
 from datetime import datetime, timezone
 import json
 import html
@@ -35,7 +36,9 @@ def norm(s: str | None, *, case_insensitive: bool) -> str:
     return t.lower() if case_insensitive else t
 
 # ---- Razorpay fetcher (reuse your existing code) ----------------------------
-from app.routers.razorpay_export import fetch_payments, _assert_keys
+from app.routers.razorpay_export import (
+    fetch_payments, _assert_keys, fetch_payments_by_ids,
+)
 # ----------------------------------------------------------------------------
 
 # ---- Mongo connection via ENV ----------------------------------------------
@@ -296,6 +299,151 @@ async def _vlookup_core(
     return resp  # already a dict
 
 
+# ---- payment_id -> order matching (indexed, incremental) --------------------
+# Orders are matched to Razorpay payments by transaction_id. Instead of scanning
+# every order, payment IDs from the window are looked up with $in against the
+# indexed raw transaction_id and its normalized twin (transaction_id_norm:
+# NBSP-free, trimmed, lowercased; "" when there is no transaction_id, so
+# unstamped docs are exactly the index's null bucket). Every match found is
+# persisted in payment_order_matches, keyed by the normalized payment id
+# ("cs:" + trimmed raw id for case-sensitive runs), so later runs over
+# overlapping windows are answered from that table first. A table hit is
+# re-checked against its order (one _id lookup per chunk); if the order is gone
+# or no longer carries that transaction_id the record is dropped and the
+# payment is matched afresh.
+payment_matches_collection = db["payment_order_matches"]
+TX_NORM_SWEEP_SECONDS = float(os.getenv("RECONCILE_TX_NORM_SWEEP_SECONDS", "600"))
+
+TX_NORM_EXPR: Dict[str, Any] = {"$cond": [
+    {"$eq": [{"$type": "$transaction_id"}, "string"]},
+    {"$toLower": {"$trim": {"input": {
+        "$replaceAll": {"input": "$transaction_id", "find": "\u00A0", "replacement": " "}
+    }}}},
+    "",
+]}
+TX_NORM_PIPELINE: List[Dict[str, Any]] = [{"$set": {"transaction_id_norm": TX_NORM_EXPR}}]
+
+_match_indexes_ready = False
+_tx_norm_swept_at = 0.0
+
+
+def _ensure_match_indexes() -> None:
+    global _match_indexes_ready
+    if _match_indexes_ready:
+        return
+    orders_collection.create_index([("transaction_id", 1)], name="transaction_id")
+    # not sparse: {"transaction_id_norm": None} (never stamped) must use it
+    orders_collection.create_index([("transaction_id_norm", 1)], name="transaction_id_norm_all")
+    payment_matches_collection.create_index([("order_id", 1)], name="order_id")
+    _match_indexes_ready = True
+
+
+def _stamp_transaction_id_norm(force: bool = False) -> int:
+    """
+    Orders get transaction_id from the storefront backend, so stamp the
+    normalized key on any that lack it or carry a stale one, at most every
+    TX_NORM_SWEEP_SECONDS.
+    """
+    global _tx_norm_swept_at
+    now = time.monotonic()
+    if not force and now - _tx_norm_swept_at < TX_NORM_SWEEP_SECONDS:
+        return 0
+    _tx_norm_swept_at = now
+    # the null bucket of the (non-sparse) index holds exactly the unstamped docs;
+    # the storefront can set or correct transaction_id after that, so also
+    # restamp any norm that no longer matches its source (a scan, hence throttled)
+    res = orders_collection.update_many(
+        {"$or": [
+            {"transaction_id_norm": None},
+            {"$expr": {"$ne": ["$transaction_id_norm", TX_NORM_EXPR]}},
+        ]},
+        TX_NORM_PIPELINE,
+    )
+    return res.modified_count
+
+
+def _match_id(key: str, case_insensitive: bool) -> str:
+    return key if case_insensitive else f"cs:{key}"
+
+
+def match_payments_to_orders(
+    payment_ids: List[str], chunk_size: int = 50_000, case_insensitive: bool = True,
+) -> Dict[str, Any]:
+    """
+    {normalized payment id -> match record} for the payment_ids that have an
+    order, plus lookup stats. Cost scales with len(payment_ids).
+    """
+    _ensure_match_indexes()
+    _stamp_transaction_id_norm()
+
+    ci = case_insensitive
+    keys = list(dict.fromkeys(norm(p, case_insensitive=ci) for p in payment_ids if p))
+    matches: Dict[str, Dict[str, Any]] = {}
+    stats = {"table_hits": 0, "new_matches": 0, "stale_matches": 0, "orders_examined": 0}
+
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        ids = {_match_id(k, ci): k for k in chunk}
+        recs = list(payment_matches_collection.find({"_id": {"$in": list(ids)}}))
+
+        # re-verify table hits: the order may be gone or its transaction_id changed
+        current = {
+            doc["_id"]: str(doc.get("transaction_id") or "")
+            for doc in orders_collection.find(
+                {"_id": {"$in": [rec.get("order_oid") for rec in recs]}},
+                projection={"transaction_id": 1},
+            )
+        }
+        stale = []
+        for rec in recs:
+            key = ids[rec["_id"]]
+            tx = current.get(rec.get("order_oid"))
+            if tx is None or norm(tx, case_insensitive=ci) != key:
+                stale.append(rec["_id"])
+                continue
+            matches[key] = {**rec, "transaction_id": tx}
+        if stale:
+            payment_matches_collection.delete_many({"_id": {"$in": stale}})
+            stats["stale_matches"] += len(stale)
+        stats["table_hits"] += len(recs) - len(stale)
+
+        unknown = [k for k in chunk if k not in matches]
+        if not unknown:
+            continue
+        unknown_set = set(unknown)
+        raw_ids = [p for p in payment_ids if norm(p, case_insensitive=ci) in unknown_set]
+        docs = orders_collection.find(
+            {"$or": [
+                {"transaction_id": {"$in": raw_ids}},
+                {"transaction_id_norm": {"$in": list({k.lower() for k in unknown})}},
+            ]},
+            projection={"transaction_id": 1, "order_id": 1},
+        )
+        ops = []
+        for doc in docs:
+            stats["orders_examined"] += 1
+            tx = str(doc.get("transaction_id") or "")
+            key = norm(tx, case_insensitive=ci)
+            # transaction_id_norm is lowercased; a case-sensitive run keeps exact matches only
+            if key not in unknown_set or key in matches:
+                continue
+            rec = {
+                "_id": _match_id(key, ci),
+                "transaction_id": tx,
+                "order_id": doc.get("order_id"),
+                "order_oid": doc["_id"],
+                "matched_at": datetime.now(timezone.utc),
+            }
+            matches[key] = rec
+            ops.append(UpdateOne({"_id": rec["_id"]}, {"$set": rec}, upsert=True))
+        if ops:
+            payment_matches_collection.bulk_write(ops, ordered=False)
+            stats["new_matches"] += len(ops)
+
+    return {"matches": matches, **stats}
+# ----------------------------------------------------------------------------
+
+
 @router.get("/vlookup-payment-to-orders/auto")
 async def vlookup_payment_to_orders_auto(
     # Payments: ALL STATUSES by default (None)
@@ -305,8 +453,8 @@ async def vlookup_payment_to_orders_auto(
     to_date:   Optional[str] = Query(None, description="YYYY-MM-DD / ISO; omit for ALL time"),
     case_insensitive_ids: bool = Query(False, description="Lowercase both sides before matching"),
 
-    # Orders paging (scan *all* orders)
-    orders_batch_size: int = Query(50_000, ge=1_000, le=200_000, description="Mongo batch size"),
+    # Payment IDs per $in lookup against orders / the match table
+    orders_batch_size: int = Query(50_000, ge=1_000, le=200_000, description="Mongo $in chunk size"),
 
     # IMPORTANT: default to only NA with status=captured
     na_status: Optional[str] = Query("captured", description="Only include NA payments with this Razorpay status"),
@@ -322,6 +470,7 @@ async def vlookup_payment_to_orders_auto(
     from_unix = _to_unix_start(from_date)
     to_unix   = _to_unix_end(to_date)
     # 1) Razorpay: fetch ALL (status=None => all statuses)
+    fetch_meta: Dict[str, Any] = {}
     try:
         async with httpx.AsyncClient(
             auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")),
@@ -333,6 +482,7 @@ async def vlookup_payment_to_orders_auto(
                 from_unix=from_unix,
                 to_unix=to_unix,
                 max_fetch=max_fetch,
+                meta=fetch_meta,
             )
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
@@ -352,42 +502,23 @@ async def vlookup_payment_to_orders_auto(
     payment_keys = set(pay_index.keys())
     matched_keys: set[str] = set()
 
-    # 2) Scan ALL orders by _id (Atlas-safe)
-    total_orders_docs = 0
-    orders_with_tx = 0
-    last_id = None
-
+    # 2) Targeted lookup: only this window's payment IDs, via the match table
+    #    and the indexed transaction_id / transaction_id_norm
     try:
-        while True:
-            q: Dict[str, Any] = {}
-            if last_id is not None:
-                q["_id"] = {"$gt": last_id}
-
-            batch = list(
-                orders_collection.find(q, projection={"transaction_id": 1, "order_id": 1})
-                                 .sort([("_id", 1)])
-                                 .limit(orders_batch_size)
-            )
-            if not batch:
-                break
-
-            total_orders_docs += len(batch)
-
-            for doc in batch:
-                raw_tx = doc.get("transaction_id")
-                if not raw_tx:
-                    continue
-                tx_key = norm(str(raw_tx), case_insensitive=case_insensitive_ids)
-                if not tx_key:
-                    continue
-                orders_with_tx += 1
-                if tx_key in payment_keys:
-                    matched_keys.add(tx_key)
-
-            last_id = batch[-1]["_id"]
+        lookup = await asyncio.to_thread(
+            match_payments_to_orders,
+            [rec["id"] for rec in pay_index.values()],
+            orders_batch_size,
+            case_insensitive_ids,
+        )
     except PyMongoError as e:
         raise HTTPException(status_code=502, detail=f"Mongo query failed: {e}")
 
+    for rec in lookup["matches"].values():
+        tx_key = norm(rec.get("transaction_id"), case_insensitive=case_insensitive_ids)
+        if tx_key in payment_keys:
+            matched_keys.add(tx_key)
+
     # 3) NA keys (in payments but not matched to any order)
     na_keys = payment_keys - matched_keys
 
@@ -413,9 +544,15 @@ async def vlookup_payment_to_orders_auto(
     logger.info(f"na items {na_items}")
     return JSONResponse({
         "summary": {
-            "total_orders_docs_scanned": total_orders_docs,
-            "orders_with_transaction_id": orders_with_tx,
+            "total_orders_docs_scanned": lookup["orders_examined"],
+            "orders_with_transaction_id": len(lookup["matches"]),
+            "match_table_hits": lookup["table_hits"],
+            "match_table_new": lookup["new_matches"],
+            "match_table_stale": lookup["stale_matches"],
             "total_payments_rows": len(payments),
+            "payments_source": fetch_meta.get("source"),
+            "payments_stale": bool(fetch_meta.get("stale")),
+            "payments_synced_at_unix": fetch_meta.get("synced_at_unix"),
             "payment_status_filter": status or "(ALL)",
             "case_insensitive_ids": case_insensitive_ids,
             "matched_distinct_payment_ids": matched_distinct,
@@ -815,8 +952,30 @@ def _lookup_paid_preview_by_job(job_id: Optional[str]) -> Tuple[Optional[bool],
     except Exception:
         return (None, None)
 
-def _project_row(payment: Dict[str, Any]) -> Dict[str, Any]:
-    """Combine Razorpay fields + DB (job_id, paid, preview_url)."""
+def _prefetch_order_docs(payments: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    ({transaction_id: doc}, {job_id: doc}) for a batch of payments in two $in
+    queries, so _project_row needs no per-payment round-trips.
+    """
+    proj = {"transaction_id": 1, "job_id": 1, "paid": 1, "preview_url": 1}
+    pids = [p.get("id") for p in payments if p.get("id")]
+    by_tx = {d["transaction_id"]: d for d in orders_collection.find({"transaction_id": {"$in": pids}}, proj)}
+    job_ids = list({j for p in payments if p.get("id") not in by_tx for j in [_extract_job_id_from_payment(p)] if j})
+    by_job: Dict[str, Any] = {}
+    if job_ids:
+        by_job = {d["job_id"]: d for d in orders_collection.find({"job_id": {"$in": job_ids}}, proj)}
+    return by_tx, by_job
+
+
+def _project_row(
+    payment: Dict[str, Any],
+    by_tx: Optional[Dict[str, Any]] = None,
+    by_job: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Combine Razorpay fields + DB (job_id, paid, preview_url). Pass the maps
+    from _prefetch_order_docs to skip the per-payment lookups.
+    """
     upi = payment.get("upi") or {}
     acq = payment.get("acquirer_data") or {}
     vpa = payment.get("vpa") or upi.get("vpa") or ""
@@ -828,7 +987,10 @@ def _project_row(payment: Dict[str, Any]) -> Dict[str, Any]:
     job_id_db = None
     paid, preview_url = (None, None)
     try:
-        doc_tx = orders_collection.find_one({"transaction_id": pid}, {"job_id": 1, "paid": 1, "preview_url": 1})
+        if by_tx is not None:
+            doc_tx = by_tx.get(pid)
+        else:
+            doc_tx = orders_collection.find_one({"transaction_id": pid}, {"job_id": 1, "paid": 1, "preview_url": 1})
         if doc_tx:
             job_id_db = doc_tx.get("job_id")
             paid = bool(doc_tx.get("paid")) if "paid" in doc_tx else None
@@ -840,7 +1002,13 @@ def _project_row(payment: Dict[str, Any]) -> Dict[str, Any]:
     if not job_id_db:
         job_id_guess = _extract_job_id_from_payment(payment)
         if job_id_guess:
-            paid, preview_url = _lookup_paid_preview_by_job(job_id_guess)
+            if by_job is not None:
+                doc = by_job.get(job_id_guess)
+                if doc:
+                    paid = bool(doc.get("paid")) if "paid" in doc else None
+                    preview_url = doc.get("preview_url") if isinstance(doc.get("preview_url"), str) else None
+            else:
+                paid, preview_url = _lookup_paid_preview_by_job(job_id_guess)
             job_id_db = job_id_guess
 
     return {
@@ -884,26 +1052,27 @@ async def na_payment_details(body: Dict[str, Any]) -> Dict[str, Any]:
     items: List[Dict[str, Any]] = []
     errors: List[Dict[str, Any]] = []
 
+    # TTL cache and local mirror first; the rest is fetched concurrently
+    async with httpx.AsyncClient(
+        auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")),
+        timeout=20.0
+    ) as client:
+        found, failed = await fetch_payments_by_ids(client, uniq_ids)
+
     try:
-        async with httpx.AsyncClient(
-            auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")),
-            timeout=20.0
-        ) as client:
-            for pid in uniq_ids:
-                try:
-                    r = await client.get(f"https://api.razorpay.com/v1/payments/{pid}")
-                    if r.status_code == 404:
-                        errors.append({"id": pid, "error": "not_found"})
-                        continue
-                    r.raise_for_status()
-                    p = r.json()
-                    items.append(_project_row(p))
-                except httpx.HTTPStatusError as e:
-                    errors.append({"id": pid, "error": f"http_{e.response.status_code}", "detail": (e.response.text or "")[:200]})
-                except httpx.RequestError as e:
-                    errors.append({"id": pid, "error": "network", "detail": str(e)})
-    except httpx.RequestError as e:
-        raise HTTPException(502, detail=f"Network error calling Razorpay: {e}")
+        by_tx, by_job = await asyncio.to_thread(_prefetch_order_docs, list(found.values()))
+    except PyMongoError as e:
+        raise HTTPException(status_code=502, detail=f"Mongo query failed: {e}")
+
+    for pid in uniq_ids:
+        if pid in found:
+            items.append(_project_row(found[pid], by_tx, by_job))
+        elif failed[pid]["status"] == 404:
+            errors.append({"id": pid, "error": "not_found"})
+        elif failed[pid]["status"] is None:
+            errors.append({"id": pid, "error": "network", "detail": failed[pid]["detail"]})
+        else:
+            errors.append({"id": pid, "error": f"http_{failed[pid]['status']}", "detail": failed[pid]["detail"]})
 
     return {"count": len(items), "items": items, "errors": errors}
 
@@ -2,20 +2,40 @@
 from typing import Dict, Any
 from datetime import datetime
 import time
-from fastapi import FastAPI, HTTPException, Query, Body
-from typing import List, Dict, Any, Optional
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Query, Body, Request, Response
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator, Collection
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from dateutil import parser
 import pytz
 import os
 import re
+import json
+import threading
+import uuid
+from collections import OrderedDict, deque
+import base64
+from urllib.parse import quote
+import hashlib
+import tempfile
+import io
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import httpx
 import requests
+from bson import ObjectId
+from bson.errors import InvalidId
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, FileResponse, RedirectResponse
+from starlette.background import BackgroundTask
 from barcode import Code128
-from barcode.writer import ImageWriter
+from barcode.writer import ImageWriter, SVGWriter
+from barcode import errors as barcode_errors
+from PIL import Image, ImageDraw, ImageFont
+from PyPDF2 import PdfReader, PdfWriter
 
 
 load_dotenv()
@@ -23,7 +43,7 @@ load_dotenv()
 app = FastAPI()
 
 # -----------------------------------------------------------------------------
-# Static files for barcodes
+# Static files for barcodes and cached label PDFs
 # -----------------------------------------------------------------------------
 STATIC_DIR = "static"
 BARCODE_DIR = os.path.join(STATIC_DIR, "barcodes")
@@ -38,6 +58,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # custom response headers the dashboard reads from cross-origin fetches
+    expose_headers=["X-Labels-Missing", "X-Labels-Merged", "X-Sheet-Pages", "X-Sheet-Orders", "ETag"],
 )
 
 # -----------------------------------------------------------------------------
@@ -99,6 +121,311 @@ PRINTER_TOKENS = {
 }
 
 
+def _token_access(token: Optional[str]) -> Tuple[str, Optional[str]]:
+    """
+    Very simple token-based auth (NOT production-grade): (role, printer) for
+    a PRINTER_TOKENS token, "admin" or "printer" (then printer is its key).
+    """
+    if not token:
+        raise HTTPException(status_code=401, detail="token is required")
+
+    # Find which token this is (genesis / yara / admin)
+    for key, tok in PRINTER_TOKENS.items():
+        if tok == token:
+            return ("admin", None) if key == "admin" else ("printer", key)
+
+    # token not recognized
+    raise HTTPException(status_code=403, detail="invalid token")
+
+
+def _assert_order_access(doc: Dict[str, Any], role: str, printer: Optional[str]) -> None:
+    # printer tokens only see their own printer's orders; 404 so ids can't be probed
+    if role != "admin" and (doc.get("printer") or "").strip().lower() != printer:
+        raise HTTPException(status_code=404, detail="Order not found")
+
+
+# -----------------------------------------------------------------------------
+# Normalized order keys – printer_key / is_test
+# -----------------------------------------------------------------------------
+# `printer` is free-form ("Genesis", "genesis ") and test orders are only
+# recognisable by an order_id prefix, so neither can be filtered through an
+# index. Both are stamped onto the document as plain equality fields instead.
+#
+# order_id search works on order_id_key (lowercased, without "#", "-", "_" or
+# spaces) so prefix lookups are anchored index scans, and on order_id_grams
+# (the key's trigrams) so substring lookups are a multikey $all lookup.
+TEST_ORDER_RE = re.compile(r"^TEST#", re.I)
+ORDER_KEYS_SWEEP_SECONDS = float(os.getenv("ORDER_KEYS_SWEEP_SECONDS", "30"))
+ORDER_KEYS_RESTAMP_SECONDS = float(os.getenv("ORDER_KEYS_RESTAMP_SECONDS", "300"))
+ORDER_ID_STRIP_CHARS = "#-_ "
+ORDER_ID_GRAM = 3
+
+
+def _strip_order_id_expr(expr: Any) -> Dict[str, Any]:
+    for ch in ORDER_ID_STRIP_CHARS:
+        expr = {"$replaceAll": {"input": expr, "find": ch, "replacement": ""}}
+    return {"$toLower": expr}
+
+
+ORDER_KEYS_PIPELINE: List[Dict[str, Any]] = [
+    {"$set": {
+        "printer_key": {"$toLower": {"$trim": {"input": {"$ifNull": ["$printer", ""]}}}},
+        "is_test": {"$regexMatch": {
+            "input": {"$ifNull": ["$order_id", ""]}, "regex": "^TEST#", "options": "i",
+        }},
+        "order_id_key": _strip_order_id_expr({"$ifNull": ["$order_id", ""]}),
+    }},
+    {"$set": {
+        "order_id_grams": {"$map": {
+            "input": {"$range": [0, {"$max": [
+                0, {"$subtract": [{"$strLenCP": "$order_id_key"}, ORDER_ID_GRAM - 1]},
+            ]}]},
+            "as": "i",
+            "in": {"$substrCP": ["$order_id_key", "$$i", ORDER_ID_GRAM]},
+        }},
+    }},
+]
+
+# docs without this field have never been stamped (or predate order_id_key)
+ORDER_KEYS_MARKER = "order_id_key"
+
+# `printer` is reassigned by the storefront after stamping; a doc whose
+# printer_key no longer matches its printer must be restamped
+STALE_PRINTER_KEY_EXPR: Dict[str, Any] = {"$expr": {"$ne": [
+    {"$ifNull": ["$printer_key", None]},
+    {"$toLower": {"$trim": {"input": {"$ifNull": ["$printer", ""]}}}},
+]}}
+
+ORDERS_LIST_INDEX = [
+    ("paid", 1),
+    ("printer_key", 1),
+    ("is_test", 1),
+    ("print_sent_at", -1),
+    ("_id", -1),
+]
+
+_order_keys_sweeper: Optional[asyncio.Task] = None
+
+
+def normalize_order_id(order_id: Optional[str]) -> str:
+    key = (order_id or "").lower()
+    for ch in ORDER_ID_STRIP_CHARS:
+        key = key.replace(ch, "")
+    return key
+
+
+def order_id_grams(key: str) -> List[str]:
+    return [key[i:i + ORDER_ID_GRAM] for i in range(len(key) - ORDER_ID_GRAM + 1)]
+
+
+def order_key_fields(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Python twin of ORDER_KEYS_PIPELINE for writers that already hold the doc."""
+    key = normalize_order_id(doc.get("order_id"))
+    return {
+        "printer_key": (doc.get("printer") or "").strip().lower(),
+        "is_test": bool(TEST_ORDER_RE.match(doc.get("order_id") or "")),
+        "order_id_key": key,
+        "order_id_grams": order_id_grams(key),
+    }
+
+
+def stamp_order_keys(match: Dict[str, Any], stale_printer: bool = True) -> int:
+    """
+    Stamp the normalized order keys on docs matching `match` that lack them
+    or, with `stale_printer`, whose printer_key no longer matches `printer`.
+    The printer check is an $expr, so keep `match` selective when using it.
+    """
+    stale: List[Dict[str, Any]] = [{ORDER_KEYS_MARKER: {"$exists": False}}]
+    if stale_printer:
+        stale.append(STALE_PRINTER_KEY_EXPR)
+    res = orders_collection.update_many({**match, "$or": stale}, ORDER_KEYS_PIPELINE)
+    if res.modified_count:
+        invalidate_orders_count_cache()
+    return res.modified_count
+
+
+def printer_filter(printer: str) -> Dict[str, Any]:
+    """
+    Orders of `printer`: stamped ones by printer_key, plus paid orders the
+    sweeper has not reached yet (the printer_key null bucket, so still indexed).
+    """
+    key = printer.strip().lower()
+    return {"$or": [
+        {"printer_key": key},
+        {"printer_key": None, "printer": {"$regex": f"^\\s*{re.escape(key)}\\s*$", "$options": "i"}},
+    ]}
+
+
+# unstamped orders have no is_test yet; until the sweeper reaches them they
+# count as real orders (TEST# ones are rare and show up for at most a sweep)
+NOT_TEST: Dict[str, Any] = {"$ne": True}
+
+
+def _sweep_order_keys(stale_printer: bool = False) -> int:
+    """
+    Orders are inserted (and reassigned to printers) by the storefront
+    backend, so paid orders arrive without keys. The order_id_key index keeps
+    the lookup for unstamped docs cheap; the printer check scans paid orders
+    and runs less often.
+    """
+    return stamp_order_keys({"paid": True}, stale_printer=stale_printer)
+
+
+async def _order_keys_sweep_loop() -> None:
+    restamped_at = 0.0
+    while True:
+        try:
+            restamp = time.monotonic() - restamped_at >= ORDER_KEYS_RESTAMP_SECONDS
+            stamped = await asyncio.to_thread(_sweep_order_keys, restamp)
+            if restamp:
+                restamped_at = time.monotonic()
+            if stamped:
+                print(f"[ORDER KEYS] stamped {stamped} orders")
+        except Exception as e:
+            print(f"[ORDER KEYS] sweep error: {e}")
+        await asyncio.sleep(ORDER_KEYS_SWEEP_SECONDS)
+
+
+@app.on_event("startup")
+async def _start_order_keys_sweeper() -> None:
+    global _order_keys_sweeper
+    _order_keys_sweeper = asyncio.create_task(_order_keys_sweep_loop())
+
+
+@app.on_event("shutdown")
+async def _stop_order_keys_sweeper() -> None:
+    if _order_keys_sweeper is not None:
+        _order_keys_sweeper.cancel()
+
+
+def backfill_order_keys() -> int:
+    """One-shot: (re)stamp every document missing any of the normalized keys."""
+    res = orders_collection.update_many(
+        {"$or": [
+            {field: {"$exists": False}}
+            for field in ("printer_key", "is_test", "order_id_key", "order_id_grams")
+        ]},
+        ORDER_KEYS_PIPELINE,
+    )
+    invalidate_orders_count_cache()
+    return res.modified_count
+
+
+@app.on_event("startup")
+def _ensure_order_indexes() -> None:
+    orders_collection.create_index(ORDERS_LIST_INDEX, name="orders_list")
+    orders_collection.create_index([("order_id_key", 1)], name="order_id_key")
+    orders_collection.create_index([("order_id_grams", 1)], name="order_id_grams")
+    orders_collection.create_index([("sr_shipment_id", 1)], name="sr_shipment_id")
+
+
+# -----------------------------------------------------------------------------
+# /orders keyset cursor – opaque token built from (print_sent_at, _id)
+# -----------------------------------------------------------------------------
+def _encode_orders_cursor(doc: Dict[str, Any]) -> str:
+    """Encode the sort key of the last row of a page into an opaque cursor."""
+    sent = doc.get("print_sent_at")
+    if isinstance(sent, datetime):
+        key = {"t": "d", "v": sent.isoformat()}
+    elif sent is None or sent == "":
+        key = {"t": "n", "v": None}
+    else:
+        key = {"t": "s", "v": str(sent)}
+    key["id"] = str(doc["_id"])
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_orders_cursor(cursor: str) -> Dict[str, Any]:
+    """
+    Turn a cursor back into a Mongo predicate selecting the rows *after* it
+    in (print_sent_at DESC, _id DESC) order.
+
+    Mongo orders mixed BSON types as Date > String > Null when sorting
+    descending, so string and missing print_sent_at rows always come after a
+    date cursor, and missing ones after a string cursor.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        last_id = ObjectId(key["id"])
+        kind, value = key.get("t"), key.get("v")
+        if kind == "d":
+            value = parser.isoparse(value)
+        elif kind not in ("s", "n"):
+            raise ValueError(f"unknown cursor kind {kind!r}")
+    except (ValueError, KeyError, TypeError, InvalidId) as e:
+        raise HTTPException(status_code=400, detail=f"invalid cursor: {e}")
+
+    if kind == "n":
+        return {"print_sent_at": None, "_id": {"$lt": last_id}}
+
+    after = [
+        {"print_sent_at": {"$lt": value}},
+        {"print_sent_at": value, "_id": {"$lt": last_id}},
+        {"print_sent_at": None},
+    ]
+    if kind == "d":
+        after.append({"print_sent_at": {"$type": "string"}})
+    return {"$or": after}
+
+
+
+# -----------------------------------------------------------------------------
+# /orders total-count cache – per-filter, TTL based, invalidated on writes
+# -----------------------------------------------------------------------------
+ORDERS_COUNT_TTL = float(os.getenv("ORDERS_COUNT_TTL_SECONDS", "60"))
+ORDERS_COUNT_ESTIMATE_CAP = int(os.getenv("ORDERS_COUNT_ESTIMATE_CAP", "5000"))
+# filters include free-text search, so bound the number of cached totals (LRU)
+ORDERS_COUNT_CACHE_MAX = int(os.getenv("ORDERS_COUNT_CACHE_MAX", "1000"))
+
+_orders_count_cache: "OrderedDict[str, tuple[float, int]]" = OrderedDict()
+_orders_count_lock = threading.Lock()
+
+
+def _orders_count_key(query: Dict[str, Any]) -> str:
+    return json.dumps(query, sort_keys=True, default=str)
+
+
+def invalidate_orders_count_cache() -> None:
+    """Drop all cached /orders totals. Call after any write to user_details."""
+    with _orders_count_lock:
+        _orders_count_cache.clear()
+
+
+def _orders_total(query: Dict[str, Any], *, estimate: bool) -> tuple[int, bool]:
+    """
+    Return (total, is_estimate) for an /orders filter.
+
+    - Fresh cache hit: exact cached count.
+    - estimate=True: any cached value (even expired), else a count capped at
+      ORDERS_COUNT_ESTIMATE_CAP so Mongo stops scanning early.
+    - Otherwise: exact count_documents, cached for ORDERS_COUNT_TTL seconds.
+    """
+    key = _orders_count_key(query)
+    now = time.monotonic()
+    with _orders_count_lock:
+        hit = _orders_count_cache.get(key)
+        if hit:
+            _orders_count_cache.move_to_end(key)
+    if hit and hit[0] > now:
+        return hit[1], False
+    if estimate:
+        if hit:
+            return hit[1], True
+        capped = orders_collection.count_documents(query, limit=ORDERS_COUNT_ESTIMATE_CAP)
+        return capped, capped >= ORDERS_COUNT_ESTIMATE_CAP
+
+    total = orders_collection.count_documents(query)
+    with _orders_count_lock:
+        for k in [k for k, (expires, _) in _orders_count_cache.items() if expires <= now]:
+            del _orders_count_cache[k]
+        _orders_count_cache[key] = (now + ORDERS_COUNT_TTL, total)
+        _orders_count_cache.move_to_end(key)
+        while len(_orders_count_cache) > ORDERS_COUNT_CACHE_MAX:
+            _orders_count_cache.popitem(last=False)
+    return total, False
+
 
 @app.get("/orders")
 def get_orders(
@@ -110,45 +437,42 @@ def get_orders(
     search: Optional[str] = Query(
         None, description="Search by order_id substring"
     ),
+    search_mode: str = Query(
+        "contains", pattern="^(contains|prefix)$",
+        description="'prefix' for the anchored fast path, 'contains' for substring match"
+    ),
     token: Optional[str] = Query(
         None, description="Access token tied to printer/user"
     ),
+    cursor: Optional[str] = Query(
+        None, description="Opaque keyset cursor (next_cursor from a previous page); overrides page"
+    ),
+    include_total: bool = Query(
+        True, description="Set false to skip the total count (e.g. for polling)"
+    ),
+    estimate: bool = Query(
+        False, description="Allow a stale or capped total instead of an exact count"
+    ),
 ):
     """
     Paginated /orders endpoint for Genesis/Yara dashboards.
 
     - Returns only fields your frontend actually uses.
     - Supports:
-      - page / page_size pagination
-      - optional printer filter (case-insensitive exact match)
-      - optional search on order_id (case-insensitive substring)
+      - page / page_size pagination (legacy, cost grows with page depth)
+      - cursor / page_size keyset pagination: pass back `next_cursor` to get
+        the following page at the same cost as the first one
+      - include_total=false to skip counting, estimate=true for a cached or
+        capped total (`total_is_estimate` tells the client which it got)
+      - optional printer filter (matched on the normalized printer_key)
+      - optional search on order_id (case-insensitive substring, or prefix
+        with search_mode=prefix; "#", "-", "_" and spaces are ignored)
     - Access is controlled by `token`:
       - printer tokens can only view their own printer
       - admin token can view any printer
     """
 
-    # -------------------------------------------------------------------------
-    # Very simple token-based auth (NOT production-grade)
-    # -------------------------------------------------------------------------
-    if not token:
-        raise HTTPException(status_code=401, detail="token is required")
-
-    role: Optional[str] = None
-    printer_from_token: Optional[str] = None
-
-    # Find which token this is (genesis / yara / admin)
-    for key, tok in PRINTER_TOKENS.items():
-        if tok == token:
-            if key == "admin":
-                role = "admin"
-            else:
-                role = "printer"
-                printer_from_token = key
-            break
-
-    if role is None:
-        # token not recognized
-        raise HTTPException(status_code=403, detail="invalid token")
+    role, printer_from_token = _token_access(token)
 
     # Non-admins: force printer based on token, ignore whatever was passed
     if role != "admin":
@@ -158,35 +482,32 @@ def get_orders(
     # Query building
     # -------------------------------------------------------------------------
 
-    # base query: paid orders only (earlier behavior)
-    query: Dict[str, Any] = {"paid": True}
+    # base query: paid, non-TEST# orders – predicates on the orders_list
+    # index (paid, printer_key, is_test, print_sent_at); keys are stamped by
+    # the background sweeper, so not-yet-stamped orders are matched too
+    query: Dict[str, Any] = {"paid": True, "is_test": NOT_TEST}
 
     # optional printer filter (e.g. "genesis" / "yara")
     if printer:
-        query["printer"] = {
-            "$regex": f"^{re.escape(printer)}$",
-            "$options": "i",
-        }
-
-    # optional search filter on order_id
-    if search:
-        query["order_id"] = {
-            "$regex": re.escape(search),
-            "$options": "i",
-        }
-
-    # ensure TEST# orders are excluded BEFORE counting/pagination
-    test_re = re.compile(r"^TEST#", re.I)
+        query.update(printer_filter(printer))
+
+    # optional search filter on order_id, served from the precomputed keys
+    term = normalize_order_id(search)
+    if term:
+        if search_mode == "prefix":
+            # anchored, case-sensitive regex on a lowercase key => index range scan
+            query["order_id_key"] = {"$regex": f"^{re.escape(term)}"}
+        elif len(term) >= ORDER_ID_GRAM:
+            # trigram lookup narrows candidates, the regex checks contiguity
+            query["order_id_grams"] = {"$all": order_id_grams(term)}
+            query["order_id_key"] = {"$regex": re.escape(term)}
+        else:
+            query["order_id_key"] = {"$regex": re.escape(term)}
 
-    # If query already has clauses, convert to $and and append the negative condition
-    if query:
-        conds = []
-        for k, v in list(query.items()):
-            conds.append({k: v})
-        conds.append({"order_id": {"$not": test_re}})
-        query = {"$and": conds}
-    else:
-        query = {"order_id": {"$not": test_re}}
+    # keyset predicate is applied to the page query only, never to the count
+    page_query = query
+    if cursor:
+        page_query = {"$and": [query, _decode_orders_cursor(cursor)]}
 
     projection = {
         "order_id": 1,
@@ -200,23 +521,26 @@ def get_orders(
         "label_url": 1,
         "phone_number": 1,
         "created_at": 1,
-        "_id": 0,
+        "_id": 1,  # needed for next_cursor, not returned to the client
         "print_sent_at": 1,
         "zip": 1,  # in case you have it stored separately
     }
 
-    # total count for this filter (for UI page count)
-    total = orders_collection.count_documents(query)
+    # total count for this filter (for UI page count), served from cache
+    total: Optional[int] = None
+    total_is_estimate = False
+    if include_total:
+        total, total_is_estimate = _orders_total(query, estimate=estimate)
 
-    # paginated query
-    cursor = (
-        orders_collection.find(query, projection)
-        .sort("print_sent_at", -1)
-        .skip((page - 1) * page_size)
-        .limit(page_size)
+    # paginated query; _id breaks ties so keyset pages never skip/repeat rows
+    page_cursor = (
+        orders_collection.find(page_query, projection)
+        .sort([("print_sent_at", -1), ("_id", -1)])
     )
+    if not cursor:
+        page_cursor = page_cursor.skip((page - 1) * page_size)
 
-    records = list(cursor)
+    records = list(page_cursor.limit(page_size))
 
     result: List[Dict[str, Any]] = []
     for doc in records:
@@ -247,11 +571,17 @@ def get_orders(
             }
         )
 
+    next_cursor = (
+        _encode_orders_cursor(records[-1]) if len(records) == page_size else None
+    )
+
     return {
         "items": result,
         "total": total,
+        "total_is_estimate": total_is_estimate,
         "page": page,
         "page_size": page_size,
+        "next_cursor": next_cursor,
     }
 
 
@@ -266,7 +596,35 @@ SHIPROCKET_PASSWORD = os.getenv("SHIPROCKET_PASSWORD")
 
 
 
-def _sr_login_token() -> str:
+# Shiprocket JWTs live for days; cache one per process, refresh it shortly
+# before expiry, and (optionally) share it through Mongo so every worker
+# reuses the same login instead of each request doing its own.
+SR_TOKEN_REFRESH_SKEW = float(os.getenv("SHIPROCKET_TOKEN_REFRESH_SKEW_SECONDS", "3600"))
+SR_TOKEN_DEFAULT_TTL = float(os.getenv("SHIPROCKET_TOKEN_DEFAULT_TTL_SECONDS", "86400"))
+SR_TOKEN_SHARED = os.getenv("SHIPROCKET_TOKEN_SHARED", "1") == "1"
+SR_TOKEN_DOC_ID = "shiprocket"
+
+service_tokens_collection = db["service_tokens"]
+
+_sr_token: Dict[str, Any] = {"token": None, "exp": 0.0}
+_sr_token_lock = threading.Lock()
+
+
+def _jwt_exp(token: str) -> Optional[float]:
+    """Read the `exp` claim of a JWT without verifying it."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+def _sr_token_fresh(token: Optional[str], exp: float) -> bool:
+    return bool(token) and exp - SR_TOKEN_REFRESH_SKEW > time.time()
+
+
+def _sr_login() -> tuple[str, float]:
     if not SHIPROCKET_EMAIL or not SHIPROCKET_PASSWORD:
         raise HTTPException(
             status_code=500, detail="Shiprocket API creds missing")
@@ -282,13 +640,248 @@ def _sr_login_token() -> str:
     if not token:
         raise HTTPException(
             status_code=502, detail="Shiprocket auth returned no token")
-    return token
+    return token, _jwt_exp(token) or time.time() + SR_TOKEN_DEFAULT_TTL
+
+
+def _sr_login_token(force_refresh: bool = False, stale_token: Optional[str] = None) -> str:
+    """
+    Return a valid Shiprocket token, logging in only when the cached one is
+    missing or within SR_TOKEN_REFRESH_SKEW of expiry.
+
+    force_refresh=True (after a 401) re-logs in unless another caller already
+    replaced `stale_token` in the meantime, so a burst of 401s costs one login.
+    """
+    if not force_refresh and _sr_token_fresh(_sr_token["token"], _sr_token["exp"]):
+        return _sr_token["token"]
+
+    with _sr_token_lock:
+        token, exp = _sr_token["token"], _sr_token["exp"]
+        if _sr_token_fresh(token, exp) and (not force_refresh or token != stale_token):
+            return token
+
+        if SR_TOKEN_SHARED:
+            shared = service_tokens_collection.find_one({"_id": SR_TOKEN_DOC_ID}) or {}
+            token, exp = shared.get("token"), float(shared.get("exp") or 0)
+            if _sr_token_fresh(token, exp) and (not force_refresh or token != stale_token):
+                _sr_token.update(token=token, exp=exp)
+                return token
+
+        token, exp = _sr_login()
+        _sr_token.update(token=token, exp=exp)
+        if SR_TOKEN_SHARED:
+            service_tokens_collection.update_one(
+                {"_id": SR_TOKEN_DOC_ID},
+                {"$set": {"token": token, "exp": exp, "refreshed_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        return token
+
+
+def _sr_refreshed_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """Headers with a new token after a 401 on the token in `headers`."""
+    stale = (headers.get("Authorization") or "").removeprefix("Bearer ")
+    return _sr_headers(_sr_login_token(force_refresh=True, stale_token=stale))
 
 
 def _sr_headers(tok: str) -> Dict[str, str]:
     return {"Authorization": f"Bearer {tok}", "Content-Type": "application/json"}
 
 
+# -----------------------------------------------------------------------------
+# Async Shiprocket client – one shared httpx.AsyncClient, per-stage concurrency
+# limits and a process-wide token bucket shared by every outbound call
+# -----------------------------------------------------------------------------
+SR_RATE_PER_SEC = float(os.getenv("SHIPROCKET_RATE_PER_SEC", "4"))
+SR_RATE_MIN = float(os.getenv("SHIPROCKET_RATE_MIN_PER_SEC", "0.5"))
+SR_RATE_MAX = float(os.getenv("SHIPROCKET_RATE_MAX_PER_SEC", "20"))
+SR_RATE_INCREASE = float(os.getenv("SHIPROCKET_RATE_INCREASE", "0.05"))
+SR_BURST = int(os.getenv("SHIPROCKET_BURST", "8"))
+SR_MAX_ATTEMPTS = int(os.getenv("SHIPROCKET_MAX_ATTEMPTS", "4"))
+SR_STAGE_CONCURRENCY = {
+    "create": int(os.getenv("SHIPROCKET_CREATE_CONCURRENCY", "6")),
+    "awb": int(os.getenv("SHIPROCKET_AWB_CONCURRENCY", "4")),
+    "label": int(os.getenv("SHIPROCKET_LABEL_CONCURRENCY", "4")),
+    "pickup": int(os.getenv("SHIPROCKET_PICKUP_CONCURRENCY", "2")),
+    "track": int(os.getenv("SHIPROCKET_TRACK_CONCURRENCY", "16")),
+}
+# shipment IDs per /courier/generate/label call; 1 keeps one PDF per order
+SR_LABEL_BATCH_SIZE = int(os.getenv("SHIPROCKET_LABEL_BATCH_SIZE", "1"))
+SR_LABEL_BATCH_MAX = 50
+# default in-flight tracking probes per label-sync request
+SR_TRACK_CONCURRENCY = int(os.getenv("SHIPROCKET_SYNC_PROBE_CONCURRENCY", "8"))
+
+
+class AdaptiveRateLimiter:
+    """
+    Async token bucket whose refill rate adapts AIMD-style: every successful
+    call adds `increase` req/s (up to `max_rate`), a 429 halves the rate (down
+    to `min_rate`), empties the bucket and pauses refills until Retry-After.
+    All callers share it, so the process settles at whatever rate Shiprocket
+    currently tolerates instead of a guessed constant.
+    """
+
+    def __init__(self, rate: float, capacity: int, *, min_rate: float,
+                 max_rate: float, increase: float, decrease: float = 0.5):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.successes = 0
+        self.throttled = 0
+
+    async def acquire(self) -> None:
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    elapsed = max(0.0, now - self._updated)
+                    self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        self.successes += 1
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: float) -> None:
+        self.throttled += 1
+        now = time.monotonic()
+        # a burst of 429s from one overload only shrinks the rate once
+        if now >= self._paused_until:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._tokens = 0.0
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._updated = self._paused_until
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "rate_per_sec": round(self.rate, 3),
+            "min_rate_per_sec": self.min_rate,
+            "max_rate_per_sec": self.max_rate,
+            "paused_for_sec": round(max(0.0, self._paused_until - time.monotonic()), 3),
+            "successes": self.successes,
+            "throttled": self.throttled,
+        }
+
+
+_sr_client: Optional[httpx.AsyncClient] = None
+_sr_limiter = AdaptiveRateLimiter(
+    SR_RATE_PER_SEC, SR_BURST,
+    min_rate=SR_RATE_MIN, max_rate=SR_RATE_MAX, increase=SR_RATE_INCREASE,
+)
+_sr_stage_sems = {
+    stage: asyncio.Semaphore(limit) for stage, limit in SR_STAGE_CONCURRENCY.items()
+}
+
+
+def _sr_http() -> httpx.AsyncClient:
+    global _sr_client
+    if _sr_client is None or _sr_client.is_closed:
+        _sr_client = httpx.AsyncClient(
+            base_url=SHIPROCKET_BASE,
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+    return _sr_client
+
+
+@app.on_event("shutdown")
+async def _close_sr_http() -> None:
+    if _sr_client is not None:
+        await _sr_client.aclose()
+
+
+def _retry_after_seconds(resp: Any, attempt: int) -> float:
+    ra = resp.headers.get("Retry-After")
+    return float(ra) if ra and ra.isdigit() else float(min(6, 2 ** attempt))
+
+
+async def _sr_call(
+    method: str,
+    path: str,
+    *,
+    headers: Dict[str, str],
+    stage: str,
+    json: Any = None,
+    timeout: float = 30.0,
+) -> httpx.Response:
+    """
+    Send one Shiprocket request under the stage's concurrency limit and the
+    shared adaptive rate limiter. 429s are retried after Retry-After and a 401 is
+    retried once with a fresh token; the last response is returned as-is so
+    callers keep their own status handling.
+    """
+    relogged = False
+    async with _sr_stage_sems[stage]:
+        for attempt in range(1, SR_MAX_ATTEMPTS + 1):
+            await _sr_limiter.acquire()
+            resp = await _sr_http().request(
+                method, path, headers=headers, json=json, timeout=timeout
+            )
+            if resp.status_code == 429:
+                _sr_limiter.on_throttle(_retry_after_seconds(resp, attempt))
+                if attempt == SR_MAX_ATTEMPTS:
+                    return resp
+                continue
+            # only a 2xx says the current rate is sustainable
+            if 200 <= resp.status_code < 300:
+                _sr_limiter.on_success()
+            if resp.status_code == 401 and not relogged:
+                relogged = True
+                headers = await asyncio.to_thread(_sr_refreshed_headers, headers)
+                continue
+            return resp
+    return resp
+
+
+def _sid_key(sid: Any) -> Any:
+    """
+    Shipment IDs come back as int or numeric str; key them as int where
+    possible. This is also the canonical form stored in sr_shipment_id, so
+    lookups are a single equality match on the sr_shipment_id index.
+    """
+    return int(sid) if isinstance(sid, (int, str)) and str(sid).strip().isdigit() else sid
+
+
+def migrate_shipment_ids() -> int:
+    """One-shot: convert numeric string sr_shipment_id values to integers."""
+    res = orders_collection.update_many(
+        {"sr_shipment_id": {"$type": "string"}},
+        [{"$set": {"sr_shipment_id": {"$convert": {
+            "input": {"$trim": {"input": "$sr_shipment_id"}},
+            "to": "long",
+            "onError": "$sr_shipment_id",
+        }}}}],
+    )
+    return res.modified_count
+
+
+def _body_or_text(resp: httpx.Response) -> Any:
+    try:
+        return resp.json()
+    except Exception:
+        return resp.text
+
+
+# printer_key -> pickup name; must match the pickup names configured in Shiprocket
+SR_PICKUP_LOCATIONS: Dict[str, str] = {
+    "yara": "Diffrun",
+    "genesis": "warehouse-1",
+}
+
+
 def _sr_order_payload_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
     ship = doc.get("shipping_address") or {}
 
@@ -341,17 +934,12 @@ def _sr_order_payload_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
 
     # ---- PICKUP LOCATION BASED ON PRINTER ----
     printer = (doc.get("printer") or "").strip().lower()
-
-    if printer == "yara":
-        # must match the pickup name configured in Shiprocket
-        pickup_name = "Diffrun"
-    elif printer == "genesis":
-        # must match the pickup name configured in Shiprocket
-        pickup_name = "warehouse-1"
+    pickup_name = SR_PICKUP_LOCATIONS.get(printer)
 
     if not pickup_name:
         raise HTTPException(
-            status_code=400, detail="Shiprocket pickup_location not configured"
+            status_code=400,
+            detail=f"Shiprocket pickup_location not configured for printer {printer or '(none)'!r}",
         )
 
     # payment
@@ -411,9 +999,389 @@ def _sr_order_payload_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+# -----------------------------------------------------------------------------
+# Shiprocket payload precompute + validation
+# -----------------------------------------------------------------------------
+# Payloads are built and validated ahead of time (sweep below) and stored on
+# the order as sr_payload / sr_payload_errors, keyed by a fingerprint of the
+# fields they are built from. Create calls reuse a stored payload while the
+# fingerprint still matches and never send an order that failed validation.
+SR_PAYLOAD_SOURCE_FIELDS = (
+    "order_id", "order_id_long", "shipping_address", "user_name", "name", "email", "customer_email",
+    "phone_number", "quantity", "total_amount", "total_price", "amount", "price", "book_id",
+    "book_style", "weight_kg", "processed_at", "created_at", "printer", "payment_method", "comment",
+)
+SR_PAYLOAD_SWEEP_SECONDS = float(os.getenv("SHIPROCKET_PAYLOAD_SWEEP_SECONDS", "60"))
+SR_PAYLOAD_SWEEP_LIMIT = int(os.getenv("SHIPROCKET_PAYLOAD_SWEEP_LIMIT", "500"))
+
+# paid orders not yet created on Shiprocket and without a (current) payload
+SR_PAYLOAD_PENDING_QUERY: Dict[str, Any] = {
+    "paid": True,
+    "is_test": False,
+    "sr_shipment_id": None,
+    "sr_payload_fingerprint": None,
+}
+
+_PINCODE_RE = re.compile(r"^[1-9]\d{5}$")
+
+_payload_sweeper: Optional[asyncio.Task] = None
+
+
+def sr_payload_fingerprint(doc: Dict[str, Any]) -> str:
+    source = {f: doc.get(f) for f in SR_PAYLOAD_SOURCE_FIELDS}
+    return hashlib.sha256(json.dumps(source, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def validate_sr_payload(payload: Dict[str, Any]) -> List[str]:
+    """Problems Shiprocket would reject the create call for."""
+    errors: List[str] = []
+    if not payload.get("pickup_location"):
+        errors.append("pickup_location missing")
+    for key in ("billing_address", "billing_city", "billing_state"):
+        if not str(payload.get(key) or "").strip():
+            errors.append(f"{key} missing")
+    if not _PINCODE_RE.match(str(payload.get("billing_pincode") or "")):
+        errors.append(f"billing_pincode invalid: {payload.get('billing_pincode')!r}")
+    phone = re.sub(r"\D", "", str(payload.get("billing_phone") or ""))
+    if len(phone) < 10:
+        errors.append(f"billing_phone invalid: {payload.get('billing_phone')!r}")
+    if float(payload.get("sub_total") or 0) <= 0:
+        errors.append("sub_total must be > 0")
+    return errors
+
+
+def build_sr_payload(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """The sr_payload* fields for `doc` (payload is None when it cannot be built)."""
+    try:
+        payload: Optional[Dict[str, Any]] = _sr_order_payload_from_doc(doc)
+        errors = validate_sr_payload(payload)
+    except HTTPException as e:
+        payload, errors = None, [str(e.detail)]
+    except Exception as e:
+        payload, errors = None, [f"payload build failed: {e}"]
+    return {
+        "sr_payload": payload,
+        "sr_payload_errors": errors,
+        "sr_payload_fingerprint": sr_payload_fingerprint(doc),
+        "sr_payload_at": datetime.utcnow().isoformat(),
+    }
+
+
+def sr_payload_for(doc: Dict[str, Any]) -> tuple[Dict[str, Any], bool]:
+    """
+    (sr_payload* fields, fresh) for `doc`: the stored precompute while its
+    fingerprint matches, otherwise a rebuilt one (fresh=True, caller persists).
+    """
+    if doc.get("sr_payload_fingerprint") == sr_payload_fingerprint(doc) and "sr_payload_errors" in doc:
+        return {k: doc.get(k) for k in ("sr_payload", "sr_payload_errors", "sr_payload_fingerprint")}, False
+    fields = build_sr_payload(doc)
+    doc.update(fields)
+    return fields, True
+
+
+def precompute_sr_payloads(limit: int = SR_PAYLOAD_SWEEP_LIMIT) -> Dict[str, int]:
+    """Build + validate payloads for pending paid orders in one bulk write."""
+    projection = {f: 1 for f in SR_PAYLOAD_SOURCE_FIELDS}
+    docs = list(orders_collection.find(SR_PAYLOAD_PENDING_QUERY, projection).limit(limit))
+    ops, invalid = [], 0
+    for doc in docs:
+        fields = build_sr_payload(doc)
+        invalid += bool(fields["sr_payload_errors"])
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+    if ops:
+        orders_collection.bulk_write(ops, ordered=False)
+    return {"processed": len(ops), "invalid": invalid}
+
+
+async def _payload_sweep_loop() -> None:
+    while True:
+        try:
+            res = await asyncio.to_thread(precompute_sr_payloads)
+            if res["processed"]:
+                print(f"[SR PAYLOAD] precomputed {res['processed']} payloads ({res['invalid']} invalid)")
+        except Exception as e:
+            print(f"[SR PAYLOAD] sweep error: {e}")
+        await asyncio.sleep(SR_PAYLOAD_SWEEP_SECONDS)
+
+
+@app.on_event("startup")
+async def _start_payload_precompute() -> None:
+    global _payload_sweeper
+    orders_collection.create_index([("sr_payload_fingerprint", 1)], name="sr_payload_fingerprint")
+    _payload_sweeper = asyncio.create_task(_payload_sweep_loop())
+
+
+@app.on_event("shutdown")
+async def _stop_payload_precompute() -> None:
+    if _payload_sweeper is not None:
+        _payload_sweeper.cancel()
+
+
+
+def _pickup_fields(pickup_loc: str) -> Dict[str, Any]:
+    return {"pickup_requested": True, "pickup_requested_at": datetime.utcnow().isoformat(),
+            "pickup_location_used": pickup_loc}
+
+
+async def _sr_request_pickups(
+    pickup_map: Dict[str, List[int]],
+    headers: Dict[str, str],
+) -> tuple[Dict[str, Any], List[str], Dict[int, str]]:
+    """
+    Request pickups for {pickup_location: [shipment_ids]}: one grouped call
+    per location (Shiprocket often requires the same pickup location), falling
+    back to per-shipment calls when the account forbids bulk pickups.
+
+    Returns (responses by location, error strings, {picked sid: location});
+    persisting the pickup flags is left to the caller.
+    """
+    pickup_res: Dict[str, Any] = {}
+    picked: Dict[int, str] = {}
+
+    async def _pickup_single(pickup_loc: str, sid: int) -> List[str]:
+        single_payload: Dict[str, Any] = {"shipment_id": [sid]}
+        # include pickup_location if available
+        if pickup_loc and pickup_loc != "default":
+            single_payload["pickup_location"] = pickup_loc
+        try:
+            sr = await _sr_call(
+                "POST", "/v1/external/courier/generate/pickup",
+                headers=headers, stage="pickup", json=single_payload, timeout=30,
+            )
+        except Exception as e:
+            return [f"pickup({sid}) exception single call: {e}"]
+
+        sbody = _body_or_text(sr)
+        if sr.status_code != 200:
+            return [f"pickup({sid}) single call failed {sr.status_code}: {sbody}"]
+
+        # store individual pickup response under a composite key
+        pickup_res.setdefault(pickup_loc, {})[str(sid)] = sbody
+        picked[sid] = pickup_loc
+        return []
+
+    async def _pickup_group(pickup_loc: str, sids: List[int]) -> List[str]:
+        payload: Dict[str, Any] = {"shipment_id": sids}
+        # Optional: include pickup_location in payload (some accounts expect it)
+        if pickup_loc and pickup_loc != "default":
+            payload["pickup_location"] = pickup_loc
+
+        try:
+            rr = await _sr_call(
+                "POST", "/v1/external/courier/generate/pickup",
+                headers=headers, stage="pickup", json=payload, timeout=30,
+            )
+        except Exception as e:
+            return [f"pickup({pickup_loc}) exception grouped call: {e}"]
+
+        # capture response for debugging
+        body = _body_or_text(rr)
+
+        if rr.status_code == 200:
+            pickup_res[pickup_loc] = body
+            picked.update((sid, pickup_loc) for sid in sids)
+            return []
+
+        # If 403 for bulk, fallback to per-shipment calls
+        if rr.status_code == 403 and "bulk" in str(body).lower():
+            errs = [f"pickup({pickup_loc}) bulk forbidden, falling back to per-shipment. body={body}"]
+            for single_errs in await asyncio.gather(*(_pickup_single(pickup_loc, sid) for sid in sids)):
+                errs.extend(single_errs)
+            return errs
+
+        # other non-200 failure
+        return [f"pickup({pickup_loc}) grouped failed {rr.status_code}: {body}"]
+
+    errors: List[str] = []
+    groups = [(loc, sids) for loc, sids in pickup_map.items() if sids]
+    for errs in await asyncio.gather(*(_pickup_group(loc, sids) for loc, sids in groups)):
+        errors.extend(errs)
+    return pickup_res, errors, picked
+
+
+# -----------------------------------------------------------------------------
+# Pickup coalescer: one grouped pickup per location per window
+# -----------------------------------------------------------------------------
+PICKUP_BATCH_WINDOW_SECONDS = float(os.getenv("PICKUP_BATCH_WINDOW_SECONDS", "120"))
+PICKUP_BATCH_MAX = int(os.getenv("PICKUP_BATCH_MAX", "50"))
+PICKUP_RETRY_SWEEP_SECONDS = float(os.getenv("PICKUP_RETRY_SWEEP_SECONDS", "60"))
+PICKUP_RETRY_BASE_SECONDS = float(os.getenv("PICKUP_RETRY_BASE_SECONDS", "60"))
+PICKUP_RETRY_MAX_SECONDS = float(os.getenv("PICKUP_RETRY_MAX_SECONDS", "3600"))
+# a process holds the shipments it batches this long; if it dies they are
+# picked up again by whichever process sweeps next
+PICKUP_CLAIM_SECONDS = PICKUP_BATCH_WINDOW_SECONDS + 300
+
+_pickup_pending: Dict[str, List[int]] = {}
+_pickup_timers: Dict[str, asyncio.Task] = {}
+_pickup_flushes: set = set()
+_pickup_sweeper: Optional[asyncio.Task] = None
+_pickup_lock = asyncio.Lock()
+_pickup_stats: Dict[str, int] = {"queued": 0, "calls": 0, "picked": 0, "retried": 0}
+
+
+async def enqueue_pickup(sid: int, pickup_loc: Optional[str], persist: bool = True) -> None:
+    """
+    Queue a shipment for the next grouped pickup at its location.
+
+    A location's batch is sent PICKUP_BATCH_WINDOW_SECONDS after its first
+    shipment arrives, or as soon as it holds PICKUP_BATCH_MAX shipments. The
+    order is flagged `pickup_pending` and claimed by this process, so if the
+    process dies another one re-queues it once the claim lapses.
+    """
+    loc = str(pickup_loc) if pickup_loc else "default"
+    if persist:
+        await asyncio.to_thread(
+            orders_collection.update_one,
+            {"sr_shipment_id": sid},
+            {"$set": {"pickup_pending": True, "pickup_pending_at": datetime.utcnow().isoformat(),
+                      "pickup_claim_until": datetime.now(timezone.utc) + timedelta(seconds=PICKUP_CLAIM_SECONDS)}},
+        )
+
+    async with _pickup_lock:
+        bucket = _pickup_pending.setdefault(loc, [])
+        if sid in bucket:
+            return
+        bucket.append(sid)
+        _pickup_stats["queued"] += 1
+        full = len(bucket) >= PICKUP_BATCH_MAX
+        if not full and loc not in _pickup_timers:
+            _pickup_timers[loc] = asyncio.create_task(_pickup_window(loc))
+
+    if full:
+        # don't make the caller (a scan) wait on the pickup call
+        task = asyncio.create_task(_flush_pickups(loc))
+        _pickup_flushes.add(task)
+        task.add_done_callback(_pickup_flushes.discard)
+
+
+async def _pickup_window(loc: str) -> None:
+    await asyncio.sleep(PICKUP_BATCH_WINDOW_SECONDS)
+    await _flush_pickups(loc)
+
+
+async def _flush_pickups(loc: str) -> None:
+    async with _pickup_lock:
+        sids = _pickup_pending.pop(loc, [])
+        timer = _pickup_timers.pop(loc, None)
+    if timer is not None and timer is not asyncio.current_task():
+        timer.cancel()
+    if not sids:
+        return
+
+    picked: Dict[int, str] = {}
+    try:
+        headers = _sr_headers(await asyncio.to_thread(_sr_login_token))
+        _, errs, picked = await _sr_request_pickups({loc: sids}, headers)
+        _pickup_stats["calls"] += 1
+    except Exception as e:
+        errs = [f"pickup({loc}) exception: {e}"]
+    _pickup_stats["picked"] += len(picked)
+    for err in errs:
+        print(f"[PICKUP BATCH] {err}")
+
+    ops = [
+        UpdateOne({"sr_shipment_id": sid},
+                  {"$set": _pickup_fields(ploc),
+                   "$unset": {"pickup_pending": "", "pickup_pending_at": "", "pickup_claim_until": "",
+                              "pickup_retry_at": "", "pickup_attempts": "", "pickup_error": ""}})
+        for sid, ploc in picked.items()
+    ]
+    failed = [sid for sid in sids if sid not in picked]
+    if failed:
+        # stay pending, back off, and let the retry sweep (any process) take them
+        now = datetime.now(timezone.utc)
+        ops.extend(
+            UpdateOne({"sr_shipment_id": sid}, [
+                {"$set": {"pickup_attempts": {"$add": [{"$ifNull": ["$pickup_attempts", 0]}, 1]},
+                          "pickup_error": "; ".join(errs)[:1000]}},
+                {"$set": {"pickup_retry_at": {"$add": [now, {"$multiply": [1000, {"$min": [
+                    PICKUP_RETRY_MAX_SECONDS,
+                    {"$multiply": [PICKUP_RETRY_BASE_SECONDS, {"$pow": [2, {"$subtract": ["$pickup_attempts", 1]}]}]},
+                ]}]}]}}},
+                {"$unset": "pickup_claim_until"},
+            ])
+            for sid in failed
+        )
+    if ops:
+        await asyncio.to_thread(orders_collection.bulk_write, ops, ordered=False)
+    print(f"[PICKUP BATCH] {loc}: requested {len(picked)}/{len(sids)} shipments")
+
+
+def _claim_pending_pickup() -> Optional[Dict[str, Any]]:
+    """
+    Atomically take one pending pickup that no live process holds and whose
+    backoff has passed, so several workers never re-queue the same shipment.
+    """
+    now = datetime.now(timezone.utc)
+    return orders_collection.find_one_and_update(
+        {"pickup_pending": True, "pickup_requested": {"$ne": True},
+         "pickup_claim_until": {"$not": {"$gte": now}},
+         "pickup_retry_at": {"$not": {"$gt": now}}},
+        {"$set": {"pickup_claim_until": now + timedelta(seconds=PICKUP_CLAIM_SECONDS)}},
+        projection={"sr_shipment_id": 1, "shiprocket_pickup_location": 1},
+    )
+
+
+async def _requeue_pending_pickups() -> int:
+    queued = 0
+    while True:
+        doc = await asyncio.to_thread(_claim_pending_pickup)
+        if not doc:
+            return queued
+        if doc.get("sr_shipment_id") is None:
+            continue
+        await enqueue_pickup(_sid_key(doc["sr_shipment_id"]), doc.get("shiprocket_pickup_location"),
+                             persist=False)
+        queued += 1
+
+
+async def _pickup_retry_loop() -> None:
+    # covers startup (orphans of a dead process) and failed batches coming off backoff
+    while True:
+        try:
+            queued = await _requeue_pending_pickups()
+            if queued:
+                _pickup_stats["retried"] += queued
+                print(f"[PICKUP BATCH] re-queued {queued} pending pickups")
+        except Exception as e:
+            print(f"[PICKUP BATCH] retry sweep error: {e}")
+        await asyncio.sleep(PICKUP_RETRY_SWEEP_SECONDS)
+
+
+@app.on_event("startup")
+async def _resume_pending_pickups() -> None:
+    global _pickup_sweeper
+    orders_collection.create_index("pickup_pending", name="pickup_pending", sparse=True)
+    _pickup_sweeper = asyncio.create_task(_pickup_retry_loop())
+
+
+@app.on_event("shutdown")
+async def _stop_pickup_timers() -> None:
+    if _pickup_sweeper is not None:
+        _pickup_sweeper.cancel()
+    for task in _pickup_timers.values():
+        task.cancel()
+    # hand what this process was holding back to the others right away
+    held = [sid for sids in _pickup_pending.values() for sid in sids]
+    if held:
+        await asyncio.to_thread(
+            orders_collection.update_many,
+            {"sr_shipment_id": {"$in": held}, "pickup_pending": True},
+            {"$unset": {"pickup_claim_until": ""}},
+        )
+
+
+def _pickup_batcher_snapshot() -> Dict[str, Any]:
+    return {
+        "window_seconds": PICKUP_BATCH_WINDOW_SECONDS,
+        "max_batch": PICKUP_BATCH_MAX,
+        "pending": {loc: len(sids) for loc, sids in _pickup_pending.items()},
+        **_pickup_stats,
+    }
+
 
 @app.post("/shiprocket/create-from-orders", tags=["shiprocket"])
-def shiprocket_create_from_orders(
+async def shiprocket_create_from_orders(
     order_ids: List[str] = Body(..., embed=True,
                                 description="Diffrun order_ids like ['#123', '#124']"),
     assign_awb: bool = Body(
@@ -422,10 +1390,29 @@ def shiprocket_create_from_orders(
         True, embed=True, description="If true, generate pickup after AWB assignment"),
     generate_label: bool = Body(
         True, embed=True, description="If true, generate label after AWB assignment"),
+    defer_pickup: bool = Body(
+        False, embed=True, description="If true, hand pickups to the batching coalescer instead of requesting now"),
+    label_batch_size: int = Body(
+        SR_LABEL_BATCH_SIZE, embed=True, ge=1, le=SR_LABEL_BATCH_MAX,
+        description="Shipment IDs per label call; >1 yields one merged PDF per batch"),
+    dry_run: bool = Body(
+        False, embed=True, description="If true, only build and validate payloads; nothing is sent"),
 ):
     """
     Creates Shiprocket orders for the provided order_ids (reads delivery details from Mongo),
     assigns AWB, generates labels and requests pickup by default.
+
+    Payloads come from the precompute (rebuilt if the order changed since);
+    orders whose payload fails validation are reported in `errors` without a
+    create call. With dry_run=true only the payloads and their validation
+    errors are returned.
+
+    Each stage runs concurrently across orders (bounded per stage by
+    SR_STAGE_CONCURRENCY and globally by the shared rate limiter); stages still
+    run one after another so pickups are grouped over the whole batch.
+
+    Mongo is touched once up front (a single $in read into an in-memory map
+    keyed by order_id and shipment_id) and once per stage (one bulk_write).
     """
     if not order_ids:
         raise HTTPException(status_code=400, detail="order_ids required")
@@ -437,102 +1424,173 @@ def shiprocket_create_from_orders(
             seen.add(oid)
             unique_ids.append(oid)
 
-    token = _sr_login_token()
-    headers = _sr_headers(token)
-
     created_refs: List[Dict[str, Any]] = []
     shipment_ids: List[int] = []
     errors: List[str] = []
 
-    # 1) Create orders (one API call per local order)
-    for oid in unique_ids:
-        doc = orders_collection.find_one({"order_id": oid})
-        if not doc:
-            errors.append(f"{oid}: not found")
+    docs = await asyncio.to_thread(
+        lambda: list(orders_collection.find({"order_id": {"$in": unique_ids}}))
+    )
+    by_order_id: Dict[str, Dict[str, Any]] = {d["order_id"]: d for d in docs}
+    by_sid: Dict[Any, Dict[str, Any]] = {}
+    for d in docs:
+        if d.get("sr_shipment_id"):
+            by_sid[_sid_key(d["sr_shipment_id"])] = d
+
+    async def _flush(ops: List[tuple[str, UpdateOne]], stage: str) -> None:
+        """
+        bulk_write the stage's (order_id, op) pairs. Shiprocket already acted on
+        these orders, so a failed write is reported per order like any other
+        stage error, never a 500 for the whole call.
+        """
+        if not ops:
+            return
+        try:
+            await asyncio.to_thread(orders_collection.bulk_write, [op for _, op in ops], ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                errors.append(f"{ops[err['index']][0]}: {stage} not saved: {err.get('errmsg')}")
+        except PyMongoError as e:
+            errors.extend(f"{oid}: {stage} not saved: {e}" for oid, _ in ops)
+
+    # 0) Payloads: reuse precomputed ones, rebuild (and persist) stale ones
+    payload_ops: List[Any] = []
+    for d in docs:
+        if d.get("sr_shipment_id"):
             continue
+        fields, fresh = sr_payload_for(d)
+        if fresh:
+            payload_ops.append((d["order_id"], UpdateOne({"_id": d["_id"]}, {"$set": fields})))
+    await _flush(payload_ops, "payload")
 
-        try:
-            # avoid duplicate create if already created
+    if dry_run:
+        return {
+            "dry_run": True,
+            "orders": [
+                {
+                    "order_id": oid,
+                    "found": oid in by_order_id,
+                    "already_created": bool(by_order_id.get(oid, {}).get("sr_shipment_id")),
+                    "valid": oid in by_order_id and not by_order_id[oid].get("sr_payload_errors"),
+                    "errors": by_order_id.get(oid, {}).get("sr_payload_errors") or [],
+                    "payload": by_order_id.get(oid, {}).get("sr_payload"),
+                }
+                for oid in unique_ids
+            ],
+        }
+
+    token = await asyncio.to_thread(_sr_login_token)
+    headers = _sr_headers(token)
+
+    def _stage_update(sid: Any, fields: Dict[str, Any]) -> tuple[str, UpdateOne]:
+        """Queue a $set for the doc owning `sid` and mirror it in the map."""
+        doc = by_sid.get(_sid_key(sid))
+        if doc is None:
+            # sr_shipment_id is stored as a canonical int (see migrate_shipment_ids)
+            return f"shipment {sid}", UpdateOne({"sr_shipment_id": _sid_key(sid)}, {"$set": fields})
+        doc.update(fields)
+        return doc["order_id"], UpdateOne({"_id": doc["_id"]}, {"$set": fields})
+
+    # 1) Create orders (one API call per local order)
+    create_ops: List[Any] = []
+
+    # unlabelled orders are claimed like the prefetcher does, and held until
+    # the call ends, so the two never create/AWB/label the same order twice
+    claims: List[tuple[Any, str]] = []
+
+    async def _create_one(oid: str) -> tuple[Optional[Dict[str, Any]], Any, List[str]]:
+        doc = by_order_id.get(oid)
+        if not doc:
+            return None, None, [f"{oid}: not found"]
+
+        if not doc.get("label_url"):
+            claimed = await asyncio.to_thread(_claim_label_order, oid)
+            if claimed:
+                doc, claim_token = claimed
+                claims.append((doc["_id"], claim_token))
+            else:
+                doc = await asyncio.to_thread(orders_collection.find_one, {"_id": doc["_id"]}) or doc
+                if not doc.get("label_url"):
+                    return None, None, [f"{oid}: in progress elsewhere (label prefetch or another create), skipped"]
+            by_order_id[oid] = doc
+            if doc.get("sr_shipment_id"):
+                by_sid[_sid_key(doc["sr_shipment_id"])] = doc
+
+        try:
+            # avoid duplicate create if already created
             existing_sid = doc.get("sr_shipment_id")
             existing_soid = doc.get("sr_order_id")
             if existing_sid:
-                # normalize to int where possible
-                try:
-                    sid_int = int(existing_sid)
-                except Exception:
-                    sid_int = existing_sid
-                created_refs.append({"order_id": oid, "sr_order_id": existing_soid,
-                                     "shipment_id": existing_sid, "skipped_create": True})
-                try:
-                    shipment_ids.append(int(sid_int))
-                except Exception:
-                    # keep as-is if cannot cast
-                    shipment_ids.append(sid_int)
-                continue
-
-            payload = _sr_order_payload_from_doc(doc)
-            r = requests.post(
-                f"{SHIPROCKET_BASE}/v1/external/orders/create/adhoc",
-                headers=headers, json=payload, timeout=40
+                ref = {"order_id": oid, "sr_order_id": existing_soid,
+                       "shipment_id": existing_sid, "skipped_create": True}
+                return ref, _sid_key(existing_sid), []
+
+            # validated ahead of time; bad orders never reach Shiprocket
+            if doc.get("sr_payload_errors") or not doc.get("sr_payload"):
+                return None, None, [f"{oid}: invalid payload: {'; '.join(doc.get('sr_payload_errors') or [])}"]
+            payload = doc["sr_payload"]
+            r = await _sr_call(
+                "POST", "/v1/external/orders/create/adhoc",
+                headers=headers, stage="create", json=payload, timeout=40,
             )
             if r.status_code != 200:
-                errors.append(f"{oid}: create failed {r.status_code} {r.text}")
-                continue
+                return None, None, [f"{oid}: create failed {r.status_code} {r.text}"]
 
             j = r.json() or {}
             sr_order_id = j.get("order_id")
             shipment_id = j.get("shipment_id")
 
-            orders_collection.update_one(
-                {"_id": doc["_id"]},
-                {"$set": {
-                    "sr_order_id": sr_order_id,
-                    "sr_shipment_id": shipment_id,
-                    "shiprocket_created_at": datetime.utcnow().isoformat(),
-                    "shiprocket_pickup_location": payload.get("pickup_location")
-                }}
-            )
+            fields = {
+                "sr_order_id": sr_order_id,
+                "sr_shipment_id": _sid_key(shipment_id) if shipment_id else shipment_id,
+                "shiprocket_created_at": datetime.utcnow().isoformat(),
+                "shiprocket_pickup_location": payload.get("pickup_location"),
+                **order_key_fields(doc),
+            }
+            doc.update(fields)
+            create_ops.append((oid, UpdateOne({"_id": doc["_id"]}, {"$set": fields})))
 
-            created_refs.append(
-                {"order_id": oid, "sr_order_id": sr_order_id, "shipment_id": shipment_id})
+            ref = {"order_id": oid, "sr_order_id": sr_order_id, "shipment_id": shipment_id}
+            sid = None
             if shipment_id:
-                try:
-                    shipment_ids.append(int(shipment_id))
-                except Exception:
-                    shipment_ids.append(shipment_id)
+                sid = _sid_key(shipment_id)
+                by_sid[sid] = doc
+            return ref, sid, []
         except Exception as e:
-            errors.append(f"{oid}: exception {e}")
+            return None, None, [f"{oid}: exception {e}"]
+
+    try:
+        for ref, sid, errs in await asyncio.gather(*(_create_one(oid) for oid in unique_ids)):
+            if ref:
+                created_refs.append(ref)
+            if sid is not None:
+                shipment_ids.append(sid)
+            errors.extend(errs)
+        await _flush(create_ops, "create")
+        await asyncio.to_thread(_renew_label_claims, [t for _, t in claims])
 
-    # --- End creation loop. Now operate on all created shipments at once ---
+        # --- End creation stage. Now operate on all created shipments at once ---
 
-    # 2) Assign AWB (run once over all shipment_ids)
-    awb_results: List[Dict[str, Any]] = []
-    if assign_awb and shipment_ids:
-        for sid in shipment_ids:
+        # 2) Assign AWB (run once over all shipment_ids)
+        awb_ops: List[Any] = []
+
+        async def _assign_one(sid: Any) -> tuple[Optional[Dict[str, Any]], List[str]]:
             try:
-                # Query DB defensively: sr_shipment_id may be stored as int or str
-                existing = orders_collection.find_one({
-                    "$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]
-                })
+                existing = by_sid.get(sid)
                 if existing and existing.get("awb_code"):
-                    awb_results.append({
-                        "shipment_id": int(sid) if isinstance(sid, (int, str)) and str(sid).isdigit() else sid,
+                    return {
+                        "shipment_id": sid,
                         "awb_code": existing.get("awb_code"),
                         "courier_company_id": existing.get("courier_company_id"),
                         "skipped_assign": True
-                    })
-                    continue
+                    }, []
 
-                rr = requests.post(
-                    f"{SHIPROCKET_BASE}/v1/external/courier/assign/awb",
-                    headers=headers,
-                    json={"shipment_id": sid},
-                    timeout=30
+                rr = await _sr_call(
+                    "POST", "/v1/external/courier/assign/awb",
+                    headers=headers, stage="awb", json={"shipment_id": sid}, timeout=30,
                 )
-
                 if rr.status_code != 200:
-                    errors.append(f"awb({sid}) failed {rr.status_code}: {rr.text}")
-                    continue
+                    return None, [f"awb({sid}) failed {rr.status_code}: {rr.text}"]
 
                 try:
                     j = rr.json() or {}
@@ -542,227 +1600,265 @@ def shiprocket_create_from_orders(
                 awb_code = j.get("awb_code")
                 courier_id = j.get("courier_company_id")
 
-                awb_entry = {
-                    "shipment_id": int(sid) if isinstance(sid, (int, str)) and str(sid).isdigit() else sid,
-                    "awb_code": awb_code,
-                    "courier_company_id": courier_id
-                }
-                awb_results.append(awb_entry)
-
                 update_fields: Dict[str, Any] = {}
                 if awb_code is not None:
                     update_fields["awb_code"] = awb_code
                 if courier_id is not None:
                     update_fields["courier_company_id"] = courier_id
-
                 if update_fields:
-                    orders_collection.update_one(
-                        {"$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]},
-                        {"$set": update_fields}
-                    )
+                    awb_ops.append(_stage_update(sid, update_fields))
 
+                return {
+                    "shipment_id": sid,
+                    "awb_code": awb_code,
+                    "courier_company_id": courier_id
+                }, []
             except Exception as e:
-                errors.append(f"awb({sid}): exception {e}")
-
-    # 3) Generate label per shipment (use shipment_id; don't require awb_code)
-    label_res = {}
-    if generate_label and awb_results:
-        label_shipments = [int(x["shipment_id"]) for x in awb_results if x.get("shipment_id")]
-        for sid in label_shipments:
-            doc = orders_collection.find_one({"$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]})
-            if doc and doc.get("label_url"):
-                continue
-
-            try:
-                payload = {"shipment_id": [sid]}
-                lr = requests.post(
-                    f"{SHIPROCKET_BASE}/v1/external/courier/generate/label",
-                    headers=headers,
-                    json=payload,
-                    timeout=60,
-                )
-
-                if lr.status_code != 200:
-                    errors.append(f"label generation failed for {sid} {lr.status_code}: {lr.text}")
+                return None, [f"awb({sid}): exception {e}"]
+
+        awb_results: List[Dict[str, Any]] = []
+        if assign_awb and shipment_ids:
+            for entry, errs in await asyncio.gather(*(_assign_one(sid) for sid in shipment_ids)):
+                if entry:
+                    awb_results.append(entry)
+                errors.extend(errs)
+            await _flush(awb_ops, "awb")
+            await asyncio.to_thread(_renew_label_claims, [t for _, t in claims])
+
+        # 3) Generate labels (use shipment_id; don't require awb_code), optionally
+        #    several shipment IDs per call – see _sr_generate_labels
+        label_ops: List[Any] = []
+        label_res = {}
+        if generate_label and awb_results:
+            label_shipments = [int(x["shipment_id"]) for x in awb_results if x.get("shipment_id")]
+            pending = [
+                sid for sid in label_shipments
+                if not (by_sid.get(sid) or {}).get("label_url")
+            ]
+            outcomes: Dict[int, Dict[str, Any]] = {}
+            async for sid, res in _sr_generate_labels(pending, headers, label_batch_size):
+                outcomes[sid] = res
+
+            for sid in pending:
+                res = outcomes[sid]
+                if not res["ok"]:
+                    if "exception" in res:
+                        errors.append(f"label generation exception for {sid}: {res['exception']}")
+                    else:
+                        errors.append(f"label generation failed for {sid} {res.get('status_code')}: {res.get('text')}")
                     continue
-
-                lj = lr.json() or {}
+                lj = res["json"]
                 label_res[str(sid)] = lj
-
-                label_url = lj.get("label_url")
-                not_created = lj.get("not_created") or []
-                failed_ids = {int(x) for x in not_created if str(x).isdigit()}
-
-                if label_url and sid not in failed_ids:
-                    orders_collection.update_one(
-                        {"$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]},
-                        {
-                            "$set": {
-                                "label_url": label_url,
-                                "label_created_at": datetime.utcnow().isoformat(),
-                            }
-                        },
-                    )
-                else:
+                if not res["label_url"]:
                     errors.append(f"label_not_created_for: shipment_id={sid}, response={lj}")
+                    continue
+                label_ops.append(_stage_update(sid, _label_fields(res)))
+            await _flush(label_ops, "label")
+
+        # 4) Generate pickup — grouped per pickup_location, see _sr_request_pickups
+        pickup_res: Dict[str, Any] = {}
+
+        if request_pickup and awb_results:
+            # Build mapping pickup_location -> [shipment_ids]
+            pickup_map: Dict[str, List[int]] = {}
+            for entry in awb_results:
+                sid = entry.get("shipment_id")
+                if sid is None:
+                    continue
+                doc = by_sid.get(sid)
+                pickup_loc = doc.get("shiprocket_pickup_location") if doc else None
+                key = str(pickup_loc) if pickup_loc else "default"
+                pickup_map.setdefault(key, []).append(int(sid))
+
+            if defer_pickup:
+                for key, sids in pickup_map.items():
+                    for sid in sids:
+                        await enqueue_pickup(sid, key)
+                    pickup_res[key] = {"queued": len(sids)}
+            else:
+                pickup_res, errs, picked = await _sr_request_pickups(pickup_map, headers)
+                errors.extend(errs)
+                await _flush([_stage_update(sid, _pickup_fields(loc)) for sid, loc in picked.items()], "pickup")
 
-            except Exception as e:
-                errors.append(f"label generation exception for {sid}: {e}")
+        invalidate_orders_count_cache()
 
-    # 4) Generate pickup — grouped by pickup_location (Shiprocket often requires same pickup location)
-        # 4) Generate pickup — try grouped pickup, fallback to per-shipment if forbidden
-    pickup_res: Dict[str, Any] = {}
-    if request_pickup and awb_results:
-        # Build mapping pickup_location -> [shipment_ids]
-        pickup_map: Dict[str, List[int]] = {}
-        for entry in awb_results:
-            sid = entry.get("shipment_id")
-            if sid is None:
-                continue
-            doc = orders_collection.find_one({"$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]})
-            pickup_loc = doc.get("shiprocket_pickup_location") if doc else None
-            key = str(pickup_loc) if pickup_loc else "default"
-            pickup_map.setdefault(key, []).append(int(sid))
+        return {"created": created_refs, "awbs": awb_results, "pickup": pickup_res, "labels": label_res, "errors": errors}
+    finally:
+        for doc_id, claim_token in claims:
+            await asyncio.to_thread(_release_label_claim, doc_id, claim_token)
 
-        for pickup_loc, sids in pickup_map.items():
-            if not sids:
-                continue
 
-            payload = {"shipment_id": sids}
-            # Optional: include pickup_location in payload (some accounts expect it)
-            if pickup_loc and pickup_loc != "default":
-                payload["pickup_location"] = pickup_loc
+async def _sr_generate_labels(
+    sids: List[int],
+    headers: Dict[str, str],
+    batch_size: int = 1,
+) -> AsyncIterator[tuple[int, Dict[str, Any]]]:
+    """
+    Generate labels for `sids`, sending up to `batch_size` shipment IDs per
+    /courier/generate/label call, and yield (sid, result) as each settles.
 
-            try:
-                rr = requests.post(
-                    f"{SHIPROCKET_BASE}/v1/external/courier/generate/pickup",
-                    headers=headers,
-                    json=payload,
-                    timeout=30
-                )
-            except Exception as e:
-                errors.append(f"pickup({pickup_loc}) exception grouped call: {e}")
-                rr = None
+    Shipments a batched call reports in `not_created` (or all of a batch whose
+    call failed outright) are retried one by one. Result is either
+    {"ok": False, status_code/text/exception} for an API failure, or
+    {"ok": True, "json": ..., "label_url": url-or-None, "batch": n}.
 
-            if rr is None:
-                continue
+    Note: Shiprocket answers a multi-shipment call with one merged PDF, so with
+    batch_size > 1 every shipment in a chunk shares that label_url.
+    """
+    settled: asyncio.Queue = asyncio.Queue()
 
-            # capture response for debugging
-            try:
-                body = rr.json()
-            except Exception:
-                body = rr.text
-
-            if rr.status_code == 200:
-                pickup_res[pickup_loc] = body
-                orders_collection.update_many(
-                    {"$or": [{"sr_shipment_id": {"$in": sids}}, {"sr_shipment_id": {"$in": [str(x) for x in sids]}}]},
-                    {"$set": {"pickup_requested": True, "pickup_requested_at": datetime.utcnow().isoformat(),
-                              "pickup_location_used": pickup_loc}}
-                )
-                continue
+    async def _call(chunk: List[int]) -> Dict[str, Any]:
+        try:
+            r = await _sr_call(
+                "POST", "/v1/external/courier/generate/label",
+                headers=headers, stage="label", json={"shipment_id": chunk}, timeout=60,
+            )
+        except Exception as e:
+            return {"ok": False, "exception": str(e)}
+        if r.status_code != 200:
+            return {"ok": False, "status_code": r.status_code, "text": r.text}
+        try:
+            return {"ok": True, "json": r.json() or {}}
+        except ValueError:
+            return {"ok": False, "status_code": r.status_code, "text": "invalid json"}
+
+    async def _chunk(chunk: List[int]) -> None:
+        done: set = set()
 
-            # If 403 for bulk, fallback to per-shipment calls
-            if rr.status_code == 403 and "bulk" in str(body).lower():
-                errors.append(f"pickup({pickup_loc}) bulk forbidden, falling back to per-shipment. body={body}")
-                for sid in sids:
-                    try:
-                        single_payload = {"shipment_id": [sid]}
-                        # include pickup_location if available
-                        if pickup_loc and pickup_loc != "default":
-                            single_payload["pickup_location"] = pickup_loc
-
-                        sr = requests.post(
-                            f"{SHIPROCKET_BASE}/v1/external/courier/generate/pickup",
-                            headers=headers,
-                            json=single_payload,
-                            timeout=30
-                        )
-                    except Exception as e:
-                        errors.append(f"pickup({sid}) exception single call: {e}")
-                        continue
-
-                    try:
-                        sbody = sr.json()
-                    except Exception:
-                        sbody = sr.text
-
-                    if sr.status_code == 200:
-                        # store individual pickup response under a composite key
-                        pickup_res.setdefault(pickup_loc, {})[str(sid)] = sbody
-                        orders_collection.update_one(
-                            {"$or": [{"sr_shipment_id": sid}, {"sr_shipment_id": str(sid)}]},
-                            {"$set": {"pickup_requested": True, "pickup_requested_at": datetime.utcnow().isoformat(),
-                                      "pickup_location_used": pickup_loc}}
-                        )
+        def _settle(sid: int, res: Dict[str, Any]) -> None:
+            done.add(sid)
+            settled.put_nowait((sid, res))
+
+        try:
+            res = await _call(chunk)
+            if res["ok"] and not isinstance(res["json"], dict):
+                res = {"ok": False, "status_code": 200, "text": f"unexpected body: {str(res['json'])[:200]}"}
+            if not res["ok"]:
+                if len(chunk) == 1:
+                    _settle(chunk[0], res)
+                    return
+                retry = list(chunk)
+            else:
+                lj = res["json"]
+                label_url = lj.get("label_url")
+                not_created = {int(x) for x in lj.get("not_created") or [] if str(x).isdigit()}
+                retry = []
+                for sid in chunk:
+                    if label_url and sid not in not_created:
+                        _settle(sid, {**res, "label_url": label_url, "batch": len(chunk)})
+                    elif len(chunk) == 1:
+                        _settle(sid, {**res, "label_url": None, "batch": 1})
                     else:
-                        errors.append(f"pickup({sid}) single call failed {sr.status_code}: {sbody}")
-                continue
+                        retry.append(sid)
+            if retry:
+                await asyncio.gather(*(_chunk([sid]) for sid in retry))
+                done.update(retry)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # every sid must settle exactly once or the consumer waits forever
+            for sid in chunk:
+                if sid not in done:
+                    _settle(sid, {"ok": False, "exception": str(e)})
+
+    size = max(1, batch_size)
+    chunks = deque(sids[i:i + size] for i in range(0, len(sids), size))
+
+    async def _worker() -> None:
+        while chunks:
+            await _chunk(chunks.popleft())
+
+    # as many chunks in flight as the label stage allows; the shared limiter
+    # paces them
+    tasks = [
+        asyncio.create_task(_worker())
+        for _ in range(min(len(chunks), max(1, SR_STAGE_CONCURRENCY["label"])))
+    ]
+    try:
+        for _ in range(len(sids)):
+            yield await settled.get()
+    finally:
+        for task in tasks:
+            task.cancel()
 
-            # other non-200 failure
-            errors.append(f"pickup({pickup_loc}) grouped failed {rr.status_code}: {body}")
 
+def _label_fields(res: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "label_url": res["label_url"],
+        "label_created_at": datetime.utcnow().isoformat(),
+        "label_batch_size": res.get("batch", 1),
+    }
 
-    return {"created": created_refs, "awbs": awb_results, "pickup": pickup_res, "labels": label_res, "errors": errors}
 
+async def _sr_track_shipment(shipment_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
+    """Tracking lookup via the shared client; 429/401 retries happen in _sr_call."""
+    try:
+        r = await _sr_call(
+            "GET", f"/v1/external/courier/track/shipment/{shipment_id}",
+            headers=headers, stage="track", timeout=20,
+        )
+    except Exception as e:
+        return {"ok": False, "exception": str(e)}
 
-def _sr_get_shipment_tracking_with_retries(shipment_id: int, headers: Dict[str, str], tries: int = 3) -> Dict[str, Any]:
-    url = f"{SHIPROCKET_BASE}/v1/external/courier/track/shipment/{shipment_id}"
-    for attempt in range(1, tries + 1):
+    if r.status_code == 200:
         try:
-            r = requests.get(url, headers=headers, timeout=20)
-        except Exception as e:
-            return {"ok": False, "exception": str(e)}
+            return {"ok": True, "json": r.json()}
+        except ValueError:
+            return {"ok": False, "status_code": r.status_code, "text": "invalid json"}
 
-        if r.status_code == 200:
-            try:
-                return {"ok": True, "json": r.json()}
-            except:
-                return {"ok": False, "status_code": r.status_code, "text": "invalid json"}
-
-        if r.status_code == 429:
-            ra = r.headers.get("Retry-After")
-            wait = int(ra) if ra and ra.isdigit() else min(6, 2 ** attempt)
-            time.sleep(wait)
-            continue
+    if r.status_code == 429:
+        return {"ok": False, "status_code": 429, "text": "Too Many Attempts"}
 
-        return {"ok": False, "status_code": r.status_code, "text": r.text}
+    return {"ok": False, "status_code": r.status_code, "text": r.text}
 
-    return {"ok": False, "status_code": 429, "text": "Too Many Attempts"}
 
+def _label_eligibility(tr: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """None if the shipment may get a label, else the reason it was skipped."""
+    if not tr.get("ok"):
+        return {"reason": "tracking_failed", "resp": tr}
 
-# ============================================================
-#   FINAL VERSION — PER SHIPMENT LABEL GENERATION
-# ============================================================
-@app.post("/shiprocket/sync-missing-labels", tags=["shiprocket"])
-def shiprocket_sync_missing_labels(
-    batch_size: int = 40,
-    printer: str = Body("genesis")
-):
-    printer = (printer or "genesis").strip().lower()
-    if printer not in ("genesis", "yara"):
-        raise HTTPException(status_code=400, detail="Invalid printer")
+    tracking_json = tr["json"]
+    td = tracking_json.get("tracking_data")
+    if not td:
+        return {"reason": "no_tracking_data", "resp": tracking_json}
 
-    token = _sr_login_token()
-    headers = _sr_headers(token)
+    status_code = td.get("shipment_status")
+    try:
+        if int(status_code) == 19 or int(status_code) == 3:     # STRICT RULE
+            return None
+        return {"reason": "shipment_status_not_19", "shipment_status": status_code}
+    except (TypeError, ValueError):
+        return {"reason": "invalid_status", "shipment_status": status_code}
+
+
+async def _sync_missing_labels_events(
+    printer: str,
+    headers: Dict[str, str],
+    concurrency: int,
+    assume_eligible: Collection[int] = (),
+    label_batch_size: int = 1,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Drive a label sync for one printer, yielding progress events:
+    one "probe" per tracking lookup (in completion order), one "label" per
+    label call, and a final "done" event carrying the summary.
 
+    Shipments in `assume_eligible` (already probed by a resumed job) skip the
+    tracking lookup; shipments labelled earlier drop out of the query itself.
+    """
     # ------- 1. Find orders missing label_url -------
+    # the sweeper restamps reassigned printers; only new orders need keys here
+    await asyncio.to_thread(stamp_order_keys, {"paid": True}, False)
     query = {
         "paid": True,
-        "printer": {"$regex": f"^{re.escape(printer)}$", "$options": "i"},
+        "printer_key": printer,
         "sr_shipment_id": {"$exists": True, "$ne": None},
-        "$or": [
-            {"label_url": {"$exists": False}},
-            {"label_url": ""},
-            {"label_url": None},
-        ],
+        # null also matches a missing label_url
+        "label_url": {"$in": ["", None]},
     }
 
-    docs = list(
-        orders_collection.find(
-            query,
-            {"order_id": 1, "sr_shipment_id": 1}
-        )
+    docs = await asyncio.to_thread(
+        lambda: list(orders_collection.find(query, {"order_id": 1, "sr_shipment_id": 1}))
     )
 
     candidates = {}
@@ -772,116 +1868,407 @@ def shiprocket_sync_missing_labels(
             continue
         try:
             candidates[int(sid)] = d.get("order_id")
-        except:
+        except (TypeError, ValueError):
             continue
 
     if not candidates:
-        return {"message": "No candidate orders", "matched_docs": len(docs)}
+        yield {"event": "done", "message": "No candidate orders", "matched_docs": len(docs)}
+        return
 
-    eligible_shipments = []
+    eligible = set()
     skipped = {}
 
     all_sids = list(candidates.keys())
+    yield {"event": "candidates", "count": len(all_sids)}
 
     # ------- 2. Determine which shipments have status == 19 -------
-    for i in range(0, len(all_sids), batch_size):
-        batch = all_sids[i: i + batch_size]
-
-        for sid in batch:
-            tr = _sr_get_shipment_tracking_with_retries(sid, headers, tries=3)
-
-            if not tr.get("ok"):
-                skipped[sid] = {"reason": "tracking_failed", "resp": tr}
-                continue
-
-            tracking_json = tr["json"]
-            td = tracking_json.get("tracking_data")
-
-            if not td:
-                skipped[sid] = {"reason": "no_tracking_data",
-                                "resp": tracking_json}
-                continue
-
-            status_code = td.get("shipment_status")
-
-            try:
-                if int(status_code) == 19 or int(status_code) == 3 :     # STRICT RULE
-                    eligible_shipments.append(sid)
-                else:
-                    skipped[sid] = {
-                        "reason": "shipment_status_not_19",
-                        "shipment_status": status_code
-                    }
-            except:
-                skipped[sid] = {
-                    "reason": "invalid_status",
-                    "shipment_status": status_code
-                }
+    # fan out under a per-request cap; the shared limiter paces the whole
+    # process and backs every probe off together on 429
+    probe_sem = asyncio.Semaphore(concurrency)
+
+    async def _probe(sid: int) -> tuple[int, Dict[str, Any]]:
+        async with probe_sem:
+            return sid, await _sr_track_shipment(sid, headers)
+
+    for sid in all_sids:
+        if sid in assume_eligible:
+            eligible.add(sid)
+            yield {"event": "probe", "shipment_id": sid, "order_id": candidates[sid],
+                   "eligible": True, "skip": None}
+
+    to_probe = [sid for sid in all_sids if sid not in eligible]
+    for fut in asyncio.as_completed([_probe(sid) for sid in to_probe]):
+        sid, tr = await fut
+        reason = _label_eligibility(tr)
+        if reason is None:
+            eligible.add(sid)
+        else:
+            skipped[sid] = reason
+        yield {"event": "probe", "shipment_id": sid, "order_id": candidates[sid],
+               "eligible": reason is None, "skip": reason}
 
-        time.sleep(1)
+    # keep candidate order regardless of which probe finished first
+    eligible_shipments = [sid for sid in all_sids if sid in eligible]
 
     if not eligible_shipments:
-        return {
+        yield {
+            "event": "done",
             "message": "No eligible shipments",
             "eligible_count": 0,
             "skipped": skipped
         }
+        return
 
     # ============================================================
-    # 3. GENERATE LABEL FOR EACH SHIPMENT (one-by-one, not batch)
+    # 3. GENERATE LABELS (per shipment, or batch_size IDs per call)
     # ============================================================
     succeeded = []
     failed = []
     per_label_results = {}
+    label_ops: List[Any] = []
+
+    async def _flush_labels() -> None:
+        # labels are billed once generated: persist them batch by batch so a
+        # crash (and the resumed job) never has to generate them again
+        if label_ops:
+            ops = list(label_ops)
+            label_ops.clear()
+            await asyncio.to_thread(orders_collection.bulk_write, ops, ordered=False)
+
+    # pacing comes from _sr_limiter, which tracks Shiprocket's actual limit
+    try:
+        async for sid, res in _sr_generate_labels(eligible_shipments, headers, label_batch_size):
+            per_label_results[sid] = res
+
+            if not res.get("ok"):
+                failed.append(sid)
+                skipped[sid] = {"reason": "label_api_failed", "resp": res}
+                yield {"event": "label", "shipment_id": sid, "ok": False}
+                continue
+
+            if res["label_url"]:
+                label_ops.append(UpdateOne({"sr_shipment_id": sid}, {"$set": _label_fields(res)}))
+                succeeded.append(sid)
+                if len(label_ops) >= max(1, label_batch_size):
+                    await _flush_labels()
+                yield {"event": "label", "shipment_id": sid, "ok": True, "label_url": res["label_url"]}
+            else:
+                failed.append(sid)
+                skipped[sid] = {"reason": "label_not_created", "response": res["json"]}
+                yield {"event": "label", "shipment_id": sid, "ok": False}
+    finally:
+        await _flush_labels()
+
+    if succeeded:
+        invalidate_orders_count_cache()
+
+    yield {
+        "event": "done",
+        "message": (
+            "Labels generated individually" if label_batch_size <= 1
+            else f"Labels generated in batches of {label_batch_size}"
+        ),
+        "eligible_shipments": eligible_shipments,
+        "succeeded_shipments": succeeded,
+        "failed_shipments": failed,
+        "results": per_label_results,
+        "skipped": skipped,
+    }
 
-    def generate_label_single(sid):
-        url = f"{SHIPROCKET_BASE}/v1/external/courier/generate/label"
-        payload = {"shipment_id": [sid]}
 
+async def _ndjson(events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for ev in events:
+        yield (json.dumps(ev, default=str) + "\n").encode("utf-8")
+
+
+# ============================================================
+#   FINAL VERSION — PER SHIPMENT LABEL GENERATION
+# ============================================================
+@app.post("/shiprocket/sync-missing-labels", tags=["shiprocket"])
+async def shiprocket_sync_missing_labels(
+    batch_size: int = Query(40, description="Deprecated; probes are paced by the shared rate limiter"),
+    printer: str = Body("genesis"),
+    concurrency: int = Query(SR_TRACK_CONCURRENCY, ge=1, le=32,
+                             description="Max tracking probes in flight for this sync"),
+    label_batch_size: int = Query(SR_LABEL_BATCH_SIZE, ge=1, le=SR_LABEL_BATCH_MAX,
+                                  description="Shipment IDs per label call; >1 yields one merged PDF per batch"),
+    stream: bool = Query(False, description="Run inline and stream progress as NDJSON events"),
+    wait: bool = Query(False, description="Run inline and return the summary when finished"),
+):
+    """
+    Generate missing labels for a printer's shipments that Shiprocket reports
+    as ready (status 19/3).
+
+    By default this enqueues a background job and returns its job_id at once;
+    poll GET /shiprocket/jobs/{job_id} for per-shipment progress and the
+    final summary. A queued/running job for the same printer is reused.
+
+    wait=true runs inline and returns the summary. stream=true runs inline
+    and streams NDJSON: "candidates", then "probe" and "label" events as they
+    complete, and a final "done" event whose body matches the summary.
+    """
+    printer = (printer or "genesis").strip().lower()
+    if printer not in ("genesis", "yara"):
+        raise HTTPException(status_code=400, detail="Invalid printer")
+
+    if not (stream or wait):
+        job, created = await asyncio.to_thread(_enqueue_label_sync_job, printer, concurrency, label_batch_size)
+        if created and _job_queue is not None:
+            _job_queue.put_nowait(job["_id"])
+        return {
+            "job_id": job["_id"],
+            "status": job["status"],
+            "status_url": f"/shiprocket/jobs/{job['_id']}",
+        }
+
+    token = await asyncio.to_thread(_sr_login_token)
+    events = _sync_missing_labels_events(
+        printer, _sr_headers(token), concurrency, label_batch_size=label_batch_size
+    )
+
+    if stream:
+        return StreamingResponse(_ndjson(events), media_type="application/x-ndjson")
+
+    summary: Dict[str, Any] = {}
+    async for ev in events:
+        summary = ev
+    summary.pop("event", None)
+    return summary
+
+
+# -----------------------------------------------------------------------------
+# Background label-sync jobs – Mongo-backed state, in-process worker pool
+# -----------------------------------------------------------------------------
+SR_JOB_WORKERS = int(os.getenv("SHIPROCKET_JOB_WORKERS", "2"))
+SR_JOB_FLUSH_EVERY = 25          # progress events per Mongo write
+SR_JOB_FLUSH_SECONDS = 1.0       # ...or at most this stale
+SR_JOB_LEASE_SECONDS = 300       # a running job untouched this long is taken over
+
+jobs_collection = db["shiprocket_jobs"]
+
+_job_queue: Optional[asyncio.Queue] = None
+_job_workers: List[asyncio.Task] = []
+
+
+def _enqueue_label_sync_job(
+    printer: str, concurrency: int, label_batch_size: int = 1
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Insert a label sync job for `printer`, or return the one already
+    queued/running. `active` is true only while a job is queued or running,
+    and the unique partial index active_job lets just one such job per
+    printer exist. Returns (job, created); runs in a worker thread, so the
+    caller puts created jobs on _job_queue from the event loop.
+    """
+    active_query = {"kind": "sync_missing_labels", "printer": printer, "active": True}
+    active = jobs_collection.find_one(active_query)
+    if active:
+        return active, False
+
+    now = datetime.now(timezone.utc)
+    job = {
+        "_id": uuid.uuid4().hex,
+        "kind": "sync_missing_labels",
+        "printer": printer,
+        "concurrency": concurrency,
+        "label_batch_size": label_batch_size,
+        "status": "queued",
+        "active": True,
+        "created_at": now,
+        "updated_at": now,
+        "progress": {"candidates": 0, "probed": 0, "eligible": 0, "labelled": 0, "failed": 0},
+        "shipments": {},
+    }
+    try:
+        jobs_collection.insert_one(job)
+    except DuplicateKeyError:
+        # a concurrent request queued one first
+        return jobs_collection.find_one(active_query) or job, False
+    return job, True
+
+
+def _claim_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Atomically take a queued job, or a running one whose lease lapsed (its
+    process died), so several workers/processes never run the same job.
+    """
+    now = datetime.now(timezone.utc)
+    return jobs_collection.find_one_and_update(
+        {"_id": job_id, "$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_until": {"$lt": now}},
+            {"status": "running", "lease_until": {"$exists": False}},
+        ]},
+        {"$set": {"status": "running", "lease_until": now + timedelta(seconds=SR_JOB_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _run_label_sync_job(job_id: str) -> None:
+    job = await asyncio.to_thread(_claim_job, job_id)
+    if not job:
+        # maybe still leased by a process that just died; retry once it lapses
+        current = await asyncio.to_thread(jobs_collection.find_one, {"_id": job_id}, {"status": 1, "lease_until": 1})
+        if not current or current.get("status") != "running" or not current.get("lease_until"):
+            return
+        remaining = (current["lease_until"] - datetime.now(timezone.utc)).total_seconds()
+        await asyncio.sleep(max(0.0, remaining) + 1)
+        job = await asyncio.to_thread(_claim_job, job_id)
+        if not job:
+            return
+
+    # shipments a previous run already found eligible don't need a new probe
+    assume_eligible = {
+        int(sid) for sid, st in (job.get("shipments") or {}).items()
+        if st.get("eligible") and not st.get("label_ok")
+    }
+    # per-shipment state is the source of truth; progress is derived from it,
+    # so a resumed walk that re-probes shipments never counts them twice
+    shipments: Dict[str, Dict[str, Any]] = {
+        str(sid): dict(st) for sid, st in (job.get("shipments") or {}).items()
+    }
+    labelled_before = sum(1 for st in shipments.values() if st.get("label_ok"))
+    pending: Dict[str, Any] = {}
+
+    def _contrib(st: Dict[str, Any]) -> Dict[str, int]:
+        return {
+            "probed": int("eligible" in st),
+            "eligible": int(bool(st.get("eligible"))),
+            "labelled": int(st.get("label_ok") is True),
+            "failed": int(st.get("label_ok") is False),
+        }
+
+    progress: Dict[str, int] = {"candidates": 0, "probed": 0, "eligible": 0, "labelled": 0, "failed": 0}
+    for st in shipments.values():
+        for k, v in _contrib(st).items():
+            progress[k] += v
+
+    def _set_candidates(candidates: int) -> None:
+        # shipments labelled by an earlier run have left the candidate query
+        progress["candidates"] = candidates + labelled_before
+
+    def _set(sid: Any, field: str, value: Any) -> None:
+        st = shipments.setdefault(str(sid), {})
+        before = _contrib(st)
+        st[field] = value
+        for k, v in _contrib(st).items():
+            progress[k] += v - before[k]
+        pending[f"shipments.{sid}.{field}"] = value
+
+    progress["candidates"] = max(int((job.get("progress") or {}).get("candidates") or 0), len(shipments))
+    last_flush = time.monotonic()
+
+    async def _flush(extra: Optional[Dict[str, Any]] = None) -> None:
+        nonlocal last_flush
+        now = datetime.now(timezone.utc)
+        fields = {**pending, **(extra or {}), "updated_at": now,
+                  "lease_until": now + timedelta(seconds=SR_JOB_LEASE_SECONDS)}
+        fields.update({f"progress.{k}": v for k, v in progress.items()})
+        pending.clear()
+        last_flush = time.monotonic()
+        await asyncio.to_thread(jobs_collection.update_one, {"_id": job_id}, {"$set": fields})
+
+    await _flush({"started_at": job.get("started_at") or datetime.now(timezone.utc)})
+    try:
+        token = await asyncio.to_thread(_sr_login_token)
+        events = _sync_missing_labels_events(
+            job["printer"], _sr_headers(token), int(job.get("concurrency") or SR_TRACK_CONCURRENCY),
+            assume_eligible=assume_eligible,
+            label_batch_size=int(job.get("label_batch_size") or 1),
+        )
+        summary: Dict[str, Any] = {}
+        async for ev in events:
+            kind = ev.get("event")
+            sid = ev.get("shipment_id")
+            if kind == "candidates":
+                _set_candidates(ev["count"])
+            elif kind == "probe":
+                _set(sid, "order_id", ev.get("order_id"))
+                _set(sid, "eligible", ev["eligible"])
+                if ev.get("skip"):
+                    _set(sid, "skip_reason", ev["skip"].get("reason"))
+            elif kind == "label":
+                _set(sid, "label_ok", ev["ok"])
+                if ev.get("label_url"):
+                    _set(sid, "label_url", ev["label_url"])
+            elif kind == "done":
+                summary = ev
+                continue
+
+            if len(pending) >= SR_JOB_FLUSH_EVERY or time.monotonic() - last_flush >= SR_JOB_FLUSH_SECONDS:
+                await _flush()
+
+        summary.pop("event", None)
+        # round-trip through JSON so int shipment-id keys become valid BSON keys
+        result = json.loads(json.dumps(summary, default=str))
+        await _flush({"status": "done", "active": False, "finished_at": datetime.now(timezone.utc), "result": result})
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        await _flush({"status": "failed", "active": False, "finished_at": datetime.now(timezone.utc), "error": detail})
+
+
+async def _job_worker() -> None:
+    while True:
+        job_id = await _job_queue.get()
         try:
-            r = requests.post(url, headers=headers, json=payload, timeout=60)
-            if r.status_code != 200:
-                return {"ok": False, "status_code": r.status_code, "text": r.text}
-            return {"ok": True, "json": r.json()}
+            await _run_label_sync_job(job_id)
         except Exception as e:
-            return {"ok": False, "exception": str(e)}
+            print(f"[SR JOBS] worker error for {job_id}: {e}")
+        finally:
+            _job_queue.task_done()
+
+
+@app.on_event("startup")
+async def _start_job_workers() -> None:
+    global _job_queue
+    _job_queue = asyncio.Queue()
+    jobs_collection.create_index([("kind", 1), ("printer", 1), ("status", 1)], name="kind_printer_status")
+    jobs_collection.create_index(
+        [("kind", 1), ("printer", 1)], name="active_job", unique=True,
+        partialFilterExpression={"active": True},
+    )
 
-    # ------- Loop each shipment individually -------
-    for sid in eligible_shipments:
-        time.sleep(0.5)   # IMPORTANT: avoid 429 rate limit
+    # resume anything a previous process left unfinished
+    unfinished = await asyncio.to_thread(
+        lambda: list(jobs_collection.find(
+            {"status": {"$in": ["queued", "running"]}}, {"_id": 1}
+        ).sort("created_at", 1))
+    )
+    for job in unfinished:
+        _job_queue.put_nowait(job["_id"])
 
-        res = generate_label_single(sid)
-        per_label_results[sid] = res
+    for _ in range(SR_JOB_WORKERS):
+        _job_workers.append(asyncio.create_task(_job_worker()))
 
-        if not res.get("ok"):
-            failed.append(sid)
-            skipped[sid] = {"reason": "label_api_failed", "resp": res}
-            continue
 
-        lj = res["json"]
-        label_url = lj.get("label_url")
-        not_created = lj.get("not_created") or []
-
-        if label_url and sid not in [int(x) for x in not_created]:
-            orders_collection.update_one(
-                {"sr_shipment_id": sid},
-                {"$set": {
-                    "label_url": label_url,
-                    "label_created_at": datetime.utcnow().isoformat()
-                }}
-            )
-            succeeded.append(sid)
-        else:
-            failed.append(sid)
-            skipped[sid] = {"reason": "label_not_created", "response": lj}
+@app.on_event("shutdown")
+async def _stop_job_workers() -> None:
+    for task in _job_workers:
+        task.cancel()
+
+
+@app.get("/shiprocket/jobs/{job_id}", tags=["shiprocket"])
+def shiprocket_job_status(job_id: str):
+    job = jobs_collection.find_one({"_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job["job_id"] = job.pop("_id")
+    return job
+
 
+@app.get("/shiprocket/metrics", tags=["shiprocket"])
+def shiprocket_metrics():
+    """Shared Shiprocket rate limiter state, stage limits, /scan-order latency and pickup batching."""
     return {
-        "message": "Labels generated individually",
-        "eligible_shipments": eligible_shipments,
-        "succeeded_shipments": succeeded,
-        "failed_shipments": failed,
-        "results": per_label_results,
-        "skipped": skipped,
+        "rate_limiter": _sr_limiter.snapshot(),
+        "stage_concurrency": SR_STAGE_CONCURRENCY,
+        "scan_latency": _scan_latency_snapshot(),
+        "pickup_batcher": _pickup_batcher_snapshot(),
+        "label_prefetch": {
+            "enabled": SR_PREFETCH_ENABLED,
+            "queued": len(_prefetch_queued),
+            "inflight": len(_prefetch_inflight),
+        },
     }
 
 
@@ -893,41 +2280,971 @@ def shiprocket_test_tracking(shipment_id: int):
 
     try:
         r = requests.get(url, headers=headers, timeout=30)
+        if r.status_code == 401:
+            r = requests.get(url, headers=_sr_refreshed_headers(headers), timeout=30)
         return {"json": r.json() if r.status_code == 200 else r.text}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 
 
+# -----------------------------------------------------------------------------
+# /scan-order fast path for the barcode label station
+# -----------------------------------------------------------------------------
+SCAN_LATENCY_WINDOW = int(os.getenv("SCAN_LATENCY_WINDOW", "1000"))
+_scan_latencies_ms: deque = deque(maxlen=SCAN_LATENCY_WINDOW)
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return round(ordered[idx], 1)
+
+
+def _scan_latency_snapshot() -> Dict[str, Any]:
+    values = list(_scan_latencies_ms)
+    return {
+        "count": len(values),
+        "p50_ms": _percentile(values, 50),
+        "p99_ms": _percentile(values, 99),
+    }
+
+
+async def _scan_generate_label(doc: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Single-order create → AWB → label, writing straight back to `doc`.
+
+    Only what the label needs happens inline: the Shiprocket order is persisted
+    right after creation (so a retry never creates a duplicate), AWB and
+    label fields are written together, and the pickup is left to the caller.
+    """
+    oid = doc.get("order_id")
+    result: Dict[str, Any] = {"created": [], "awbs": [], "labels": {}, "errors": []}
+    errors = result["errors"]
+
+    sid = _sid_key(doc["sr_shipment_id"]) if doc.get("sr_shipment_id") else None
+    if sid is None:
+        fields, fresh = sr_payload_for(doc)
+        if fresh:
+            await asyncio.to_thread(orders_collection.update_one, {"_id": doc["_id"]}, {"$set": fields})
+        if fields["sr_payload_errors"] or not fields["sr_payload"]:
+            errors.append(f"{oid}: invalid payload: {'; '.join(fields['sr_payload_errors'] or [])}")
+            return result
+        payload = fields["sr_payload"]
+        try:
+            r = await _sr_call(
+                "POST", "/v1/external/orders/create/adhoc",
+                headers=headers, stage="create", json=payload, timeout=40,
+            )
+        except Exception as e:
+            errors.append(f"{oid}: exception {getattr(e, 'detail', e)}")
+            return result
+        if r.status_code != 200:
+            errors.append(f"{oid}: create failed {r.status_code} {r.text}")
+            return result
+
+        try:
+            j = r.json() or {}
+        except ValueError:
+            j = None
+        if not isinstance(j, dict):
+            errors.append(f"{oid}: create failed 502 invalid JSON from Shiprocket: {r.text[:200]}")
+            return result
+        sid = _sid_key(j.get("shipment_id")) if j.get("shipment_id") else None
+        fields = {
+            "sr_order_id": j.get("order_id"),
+            "sr_shipment_id": sid,
+            "shiprocket_created_at": datetime.utcnow().isoformat(),
+            "shiprocket_pickup_location": payload.get("pickup_location"),
+            **order_key_fields(doc),
+        }
+        await asyncio.to_thread(orders_collection.update_one, {"_id": doc["_id"]}, {"$set": fields})
+        doc.update(fields)
+        result["created"].append({"order_id": oid, "sr_order_id": j.get("order_id"), "shipment_id": sid})
+        if sid is None:
+            return result
+
+    fields: Dict[str, Any] = {}
+    try:
+        if not doc.get("awb_code"):
+            rr = await _sr_call(
+                "POST", "/v1/external/courier/assign/awb",
+                headers=headers, stage="awb", json={"shipment_id": sid}, timeout=30,
+            )
+            if rr.status_code != 200:
+                errors.append(f"awb({sid}) failed {rr.status_code}: {rr.text}")
+                return result
+            j = _body_or_text(rr)
+            j = j if isinstance(j, dict) else {}
+            for key in ("awb_code", "courier_company_id"):
+                if j.get(key) is not None:
+                    fields[key] = j[key]
+            result["awbs"].append({"shipment_id": sid, "awb_code": j.get("awb_code"),
+                                   "courier_company_id": j.get("courier_company_id")})
+
+        async for _, res in _sr_generate_labels([sid], headers):
+            if not res["ok"]:
+                errors.append(f"label generation failed for {sid} {res.get('status_code')}: "
+                              f"{res.get('text') or res.get('exception')}")
+            elif not res["label_url"]:
+                result["labels"][str(sid)] = res["json"]
+                errors.append(f"label_not_created_for: shipment_id={sid}, response={res['json']}")
+            else:
+                result["labels"][str(sid)] = res["json"]
+                fields.update(_label_fields(res))
+    finally:
+        # AWB is persisted even when the label call fails, so it is not re-assigned
+        if fields:
+            await asyncio.to_thread(orders_collection.update_one, {"_id": doc["_id"]}, {"$set": fields})
+            doc.update(fields)
+    return result
+
+
+# -----------------------------------------------------------------------------
+# Local label PDF cache (static/labels, content-addressed, size-bounded LRU)
+# -----------------------------------------------------------------------------
+LABEL_CACHE_DIR = os.path.join(STATIC_DIR, "labels")
+os.makedirs(LABEL_CACHE_DIR, exist_ok=True)
+LABEL_CACHE_MAX_BYTES = int(os.getenv("LABEL_CACHE_MAX_MB", "2048")) * 1024 * 1024
+LABEL_CACHE_EVICT_TO = 0.9  # evict down to this fraction of the limit
+
+_label_client: Optional[httpx.AsyncClient] = None
+_label_fetches: Dict[str, asyncio.Task] = {}
+_label_cache_lock = threading.Lock()
+
+
+def _label_http() -> httpx.AsyncClient:
+    global _label_client
+    if _label_client is None:
+        _label_client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0), follow_redirects=True)
+    return _label_client
+
+
+@app.on_event("shutdown")
+async def _close_label_http() -> None:
+    if _label_client is not None:
+        await _label_client.aclose()
+
+
+def _label_cache_path(sha: str) -> str:
+    return os.path.join(LABEL_CACHE_DIR, f"{sha}.pdf")
+
+
+def _touch_cached_label(sha: str) -> bool:
+    """Mark a cached label as recently used (mtime is the LRU clock)."""
+    try:
+        os.utime(_label_cache_path(sha))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _evict_label_cache() -> int:
+    with _label_cache_lock:
+        entries = []
+        for entry in os.scandir(LABEL_CACHE_DIR):
+            if entry.is_file() and entry.name.endswith(".pdf"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total <= LABEL_CACHE_MAX_BYTES:
+            return 0
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= LABEL_CACHE_MAX_BYTES * LABEL_CACHE_EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        print(f"[LABEL CACHE] evicted {removed} labels")
+        return removed
+
+
+def _store_label_pdf(content: bytes) -> str:
+    sha = hashlib.sha256(content).hexdigest()
+    path = _label_cache_path(sha)
+    if not os.path.exists(path):
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(content)
+        os.replace(tmp, path)
+        _evict_label_cache()
+    else:
+        _touch_cached_label(sha)
+    return sha
+
+
+async def _download_label(url: str) -> str:
+    r = await _label_http().get(url)
+    if r.status_code != 200 or not r.content.startswith(b"%PDF"):
+        raise HTTPException(status_code=502, detail=f"label download failed ({r.status_code})")
+    return await asyncio.to_thread(_store_label_pdf, r.content)
+
+
+async def cache_label_pdf(doc: Dict[str, Any]) -> str:
+    """
+    Return the sha256 of the order's label PDF, downloading it into the cache
+    on first use. Orders remember (label_sha256, label_sha_url) so a
+    regenerated label_url is fetched again; concurrent callers for one URL
+    (e.g. a merged batch label) share a single download.
+    """
+    url = doc.get("label_url")
+    if not url:
+        raise HTTPException(status_code=404, detail="Order has no label")
+
+    sha = doc.get("label_sha256")
+    if sha and doc.get("label_sha_url") == url and await asyncio.to_thread(_touch_cached_label, sha):
+        return sha
+
+    task = _label_fetches.get(url)
+    if task is None:
+        task = asyncio.create_task(_download_label(url))
+        _label_fetches[url] = task
+        task.add_done_callback(lambda _t, u=url: _label_fetches.pop(u, None))
+    sha = await asyncio.shield(task)
+
+    await asyncio.to_thread(
+        orders_collection.update_one,
+        {"_id": doc["_id"]},
+        {"$set": {"label_sha256": sha, "label_sha_url": url}},
+    )
+    doc.update({"label_sha256": sha, "label_sha_url": url})
+    return sha
+
+
+@app.get("/shiprocket/labels/{order_id}", tags=["shiprocket"])
+async def shiprocket_label_pdf(
+    order_id: str,
+    request: Request,
+    token: Optional[str] = Query(None, description="Access token tied to printer/user, as for /orders"),
+):
+    """
+    Serve an order's label PDF from the local cache (ETag = content sha256).
+    If Shiprocket is unreachable and nothing is cached, redirect to label_url.
+    Labels carry customer addresses: printer tokens only get their own orders.
+    """
+    role, printer = _token_access(token)
+    doc = await asyncio.to_thread(
+        orders_collection.find_one,
+        {"order_id": order_id},
+        {"order_id": 1, "printer": 1, "label_url": 1, "label_sha256": 1, "label_sha_url": 1},
+    )
+    if not doc:
+        raise HTTPException(status_code=404, detail="Order not found")
+    _assert_order_access(doc, role, printer)
+
+    try:
+        sha = await cache_label_pdf(doc)
+    except HTTPException as e:
+        if e.status_code == 404:
+            raise
+        return RedirectResponse(doc["label_url"], status_code=307)
+    except httpx.HTTPError:
+        return RedirectResponse(doc["label_url"], status_code=307)
+
+    etag = f'"{sha}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    filename = re.sub(r"[^A-Za-z0-9_-]", "", order_id) or "label"
+    return FileResponse(
+        _label_cache_path(sha),
+        media_type="application/pdf",
+        headers={**headers, "Content-Disposition": f'inline; filename="label_{filename}.pdf"'},
+    )
+
+
+LABEL_MERGE_MAX = int(os.getenv("LABEL_MERGE_MAX", "500"))
+LABEL_MERGE_CONCURRENCY = int(os.getenv("LABEL_MERGE_CONCURRENCY", "8"))
+
+
+def _merge_label_pdfs(paths: List[str]) -> str:
+    """Merge cached label PDFs into a temp file; returns its path."""
+    writer = PdfWriter()
+    for path in paths:
+        for page in PdfReader(path).pages:
+            writer.add_page(page)
+    fd, out_path = tempfile.mkstemp(prefix="labels_", suffix=".pdf")
+    with os.fdopen(fd, "wb") as fh:
+        writer.write(fh)
+    return out_path
+
+
+@app.post("/shiprocket/labels/merged", tags=["shiprocket"])
+async def shiprocket_merged_labels(
+    order_ids: List[str] = Body(..., embed=True, description="Orders whose labels to print, in print order"),
+    token: Optional[str] = Body(None, embed=True, description="Access token tied to printer/user, as for /orders"),
+):
+    """
+    One PDF with the labels of all `order_ids`, for batch printing.
+
+    Labels are pulled through the local label cache (concurrently, reusing
+    cached files), deduplicated by content so a merged batch label prints
+    once, and merged into a temp file that is streamed back in chunks.
+    Orders without a label (or whose download failed) are listed in the
+    X-Labels-Missing header.
+    """
+    role, printer = _token_access(token)
+    unique_ids = list(dict.fromkeys(oid for oid in order_ids if oid))
+    if not unique_ids:
+        raise HTTPException(status_code=400, detail="order_ids required")
+    if len(unique_ids) > LABEL_MERGE_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {LABEL_MERGE_MAX} order_ids per request")
+
+    docs = await asyncio.to_thread(
+        lambda: list(orders_collection.find(
+            {"order_id": {"$in": unique_ids}},
+            {"order_id": 1, "printer": 1, "label_url": 1, "label_sha256": 1, "label_sha_url": 1},
+        ))
+    )
+    # other printers' orders are reported missing, like unknown ones
+    by_order_id = {
+        d["order_id"]: d for d in docs
+        if role == "admin" or (d.get("printer") or "").strip().lower() == printer
+    }
+
+    sem = asyncio.Semaphore(LABEL_MERGE_CONCURRENCY)
+
+    async def _fetch(oid: str) -> Optional[str]:
+        doc = by_order_id.get(oid)
+        if not doc or not doc.get("label_url"):
+            return None
+        async with sem:
+            try:
+                return await cache_label_pdf(doc)
+            except Exception as e:
+                print(f"[LABEL MERGE] {oid}: {getattr(e, 'detail', e)}")
+                return None
+
+    shas = await asyncio.gather(*(_fetch(oid) for oid in unique_ids))
+    missing = [oid for oid, sha in zip(unique_ids, shas) if sha is None]
+    ordered_shas = list(dict.fromkeys(sha for sha in shas if sha))
+    if not ordered_shas:
+        raise HTTPException(status_code=404, detail="No labels available for the given order_ids")
+
+    try:
+        merged_path = await asyncio.to_thread(
+            _merge_label_pdfs, [_label_cache_path(sha) for sha in ordered_shas]
+        )
+    except FileNotFoundError:
+        # evicted between download and merge; rare enough to let the caller retry
+        raise HTTPException(status_code=503, detail="Label cache changed during merge, retry")
+
+    # the temp file goes once the response is done, sent in full or not
+    return FileResponse(
+        merged_path,
+        media_type="application/pdf",
+        background=BackgroundTask(os.unlink, merged_path),
+        headers={
+            "Content-Disposition": f'attachment; filename="labels_{datetime.utcnow():%Y%m%d_%H%M%S}.pdf"',
+            "X-Labels-Merged": str(len(ordered_shas)),
+            "X-Labels-Missing": ",".join(missing)[:2000],
+        },
+    )
+
+
+# -----------------------------------------------------------------------------
+# Code128 barcodes for order IDs (content-addressed in BARCODE_DIR)
+# -----------------------------------------------------------------------------
+BARCODE_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+BARCODE_WORKERS = int(os.getenv("BARCODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+BARCODE_PRERENDER_MAX = int(os.getenv("BARCODE_PRERENDER_MAX", "2000"))
+BARCODE_OPTIONS: Dict[str, Any] = {"module_height": 12.0, "font_size": 10, "text_distance": 4.0, "quiet_zone": 4.0}
+BARCODE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_barcode_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _barcode_sha(value: str, fmt: str) -> str:
+    key = json.dumps(["code128", value, fmt, BARCODE_OPTIONS], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _barcode_path(value: str, fmt: str) -> str:
+    return os.path.join(BARCODE_DIR, f"{_barcode_sha(value, fmt)}.{fmt}")
+
+
+def _render_barcode(value: str, fmt: str) -> str:
+    """Render one barcode to BARCODE_DIR (runs in the process pool)."""
+    path = _barcode_path(value, fmt)
+    if os.path.exists(path):
+        return path
+    writer = ImageWriter(format="PNG") if fmt == "png" else SVGWriter()
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as fh:
+        Code128(value, writer=writer).write(fh, options=BARCODE_OPTIONS)
+    os.replace(tmp, path)
+    return path
+
+
+def _barcode_executor() -> ProcessPoolExecutor:
+    global _barcode_pool
+    if _barcode_pool is None:
+        _barcode_pool = ProcessPoolExecutor(max_workers=BARCODE_WORKERS)
+    return _barcode_pool
+
+
+@app.on_event("shutdown")
+def _stop_barcode_pool() -> None:
+    if _barcode_pool is not None:
+        _barcode_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_barcodes(values: List[str], fmt: str) -> Dict[str, str]:
+    """{value: path} for `values`, rendering the uncached ones in the process pool."""
+    paths = {v: _barcode_path(v, fmt) for v in values}
+    todo = [v for v, p in paths.items() if not os.path.exists(p)]
+    if todo:
+        loop = asyncio.get_running_loop()
+        pool = _barcode_executor()
+        await asyncio.gather(*(loop.run_in_executor(pool, _render_barcode, v, fmt) for v in todo))
+    return paths
+
+
+def _check_barcode_format(fmt: str) -> str:
+    fmt = fmt.lower()
+    if fmt not in BARCODE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(BARCODE_FORMATS)}")
+    return fmt
+
+
+@app.get("/barcodes/{order_id}", tags=["barcodes"])
+async def order_barcode(order_id: str, request: Request, fmt: str = Query("png", description="png or svg")):
+    """
+    Code128 barcode for an order_id. The file name is a hash of the value and
+    render options, so responses are immutable and cached for a year.
+    """
+    fmt = _check_barcode_format(fmt)
+    if not order_id.strip():
+        raise HTTPException(status_code=400, detail="order_id required")
+
+    etag = f'"{_barcode_sha(order_id, fmt)}"'
+    headers = {"ETag": etag, "Cache-Control": BARCODE_CACHE_CONTROL}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        path = (await render_barcodes([order_id], fmt))[order_id]
+    except barcode_errors.BarcodeError as e:
+        raise HTTPException(status_code=400, detail=f"cannot encode {order_id!r}: {e}")
+    return FileResponse(path, media_type=BARCODE_FORMATS[fmt], headers=headers)
+
+
+@app.post("/barcodes/prerender", tags=["barcodes"])
+async def prerender_barcodes(
+    order_ids: List[str] = Body(..., embed=True),
+    formats: List[str] = Body(["png"], embed=True, description="Any of png, svg"),
+):
+    """Render barcodes for a batch ahead of printing packing slips."""
+    values = list(dict.fromkeys(oid for oid in order_ids if oid and oid.strip()))
+    if len(values) > BARCODE_PRERENDER_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {BARCODE_PRERENDER_MAX} order_ids per request")
+    fmts = list(dict.fromkeys(_check_barcode_format(f) for f in formats))
+
+    t0 = time.perf_counter()
+    urls: Dict[str, Dict[str, str]] = {v: {} for v in values}
+    rendered = 0
+    for fmt in fmts:
+        rendered += sum(not os.path.exists(_barcode_path(v, fmt)) for v in values)
+        try:
+            paths = await render_barcodes(values, fmt)
+        except barcode_errors.BarcodeError as e:
+            raise HTTPException(status_code=400, detail=f"cannot encode barcode: {e}")
+        for v, path in paths.items():
+            urls[v][fmt] = f"/static/barcodes/{os.path.basename(path)}"
+
+    return {
+        "count": len(values),
+        "rendered": rendered,
+        "cached": len(values) * len(fmts) - rendered,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "urls": urls,
+    }
+
+
+BARCODE_SHEET_DPI = 200
+BARCODE_SHEET_COLS = int(os.getenv("BARCODE_SHEET_COLS", "3"))
+BARCODE_SHEET_ROWS = int(os.getenv("BARCODE_SHEET_ROWS", "8"))
+BARCODE_SHEET_MAX = int(os.getenv("BARCODE_SHEET_MAX", "2000"))
+BARCODE_SHEET_SIZE = (int(8.27 * BARCODE_SHEET_DPI), int(11.69 * BARCODE_SHEET_DPI))  # A4
+
+
+def _fit_text(draw: Any, text: str, font: Any, width: int) -> str:
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def _render_barcode_sheet_page(entries: List[tuple[str, str]], fmt: str) -> bytes:
+    """
+    One A4 page of (order_id, child name) cells (runs in the process pool).
+    The barcode images come from the BARCODE_DIR cache, which already prints
+    the order_id under the bars; the child name goes underneath.
+    """
+    width, height = BARCODE_SHEET_SIZE
+    margin = int(0.3 * BARCODE_SHEET_DPI)
+    pad = int(0.06 * BARCODE_SHEET_DPI)
+    cell_w = (width - 2 * margin) // BARCODE_SHEET_COLS
+    cell_h = (height - 2 * margin) // BARCODE_SHEET_ROWS
+    font = ImageFont.load_default(size=int(0.14 * BARCODE_SHEET_DPI))
+    name_h = int(0.2 * BARCODE_SHEET_DPI)
+
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    for i, (order_id, name) in enumerate(entries):
+        x = margin + (i % BARCODE_SHEET_COLS) * cell_w
+        y = margin + (i // BARCODE_SHEET_COLS) * cell_h
+        draw.rectangle([x, y, x + cell_w - 1, y + cell_h - 1], outline=(200, 200, 200))
+
+        with Image.open(_render_barcode(order_id, "png")) as img:
+            bars = img.convert("RGB")
+        bars.thumbnail((cell_w - 2 * pad, cell_h - name_h - 2 * pad))
+        page.paste(bars, (x + (cell_w - bars.width) // 2, y + pad))
+
+        if name:
+            label = _fit_text(draw, name, font, cell_w - 2 * pad)
+            draw.text((x + cell_w // 2, y + cell_h - pad - name_h // 2), label,
+                      fill="black", font=font, anchor="mm")
+
+    buf = io.BytesIO()
+    page.save(buf, "PDF" if fmt == "pdf" else "PNG", resolution=BARCODE_SHEET_DPI)
+    return buf.getvalue()
+
+
+def _merge_pdf_pages(pages: List[bytes]) -> str:
+    writer = PdfWriter()
+    for data in pages:
+        for page in PdfReader(io.BytesIO(data)).pages:
+            writer.add_page(page)
+    fd, out_path = tempfile.mkstemp(prefix="barcodes_", suffix=".pdf")
+    with os.fdopen(fd, "wb") as fh:
+        writer.write(fh)
+    return out_path
+
+
+def _print_sent_range(date_from: Optional[str], date_to: Optional[str]) -> Dict[str, Any]:
+    """print_sent_at filter for a date range; dates are IST, `date_to` is inclusive."""
+    def _parse(s: str, end: bool) -> datetime:
+        try:
+            dt = parser.parse(s)
+        except (ValueError, OverflowError):
+            raise HTTPException(status_code=400, detail=f"invalid date: {s!r}")
+        if len(s.strip()) <= 10 and end:
+            dt = dt.replace(hour=23, minute=59, second=59, microsecond=999999)
+        return IST_TZ.localize(dt) if dt.tzinfo is None else dt
+
+    bounds: Dict[str, datetime] = {}
+    if date_from:
+        bounds["$gte"] = _parse(date_from, end=False)
+    if date_to:
+        bounds["$lte"] = _parse(date_to, end=True)
+    if not bounds:
+        return {}
+    # print_sent_at is a datetime on most docs but an ISO string on some. The
+    # text bounds are whole seconds, so the upper one is exclusive at the next
+    # second: "…T23:59:59.5" must still fall inside an inclusive end date
+    def _text(dt: datetime) -> str:
+        return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+    as_text: Dict[str, str] = {}
+    if "$gte" in bounds:
+        as_text["$gte"] = _text(bounds["$gte"])
+    if "$lte" in bounds:
+        as_text["$lt"] = _text(bounds["$lte"].replace(microsecond=0) + timedelta(seconds=1))
+    return {"$or": [{"print_sent_at": bounds}, {"print_sent_at": as_text}]}
+
+
+@app.post("/barcodes/sheet", tags=["barcodes"])
+async def barcode_sheet(
+    order_ids: Optional[List[str]] = Body(None, embed=True, description="Explicit orders, in print order"),
+    printer: Optional[str] = Body(None, embed=True, description="Printer, used with the date range"),
+    date_from: Optional[str] = Body(None, embed=True, description="print_sent_at from (YYYY-MM-DD or ISO, IST)"),
+    date_to: Optional[str] = Body(None, embed=True, description="print_sent_at to, inclusive"),
+    fmt: str = Body("pdf", embed=True, description="pdf (all pages) or png (one page)"),
+    page: int = Body(1, embed=True, ge=1, description="Page to return when fmt=png"),
+    token: Optional[str] = Body(None, embed=True, description="PRINTER_TOKENS token"),
+):
+    """
+    Print-ready barcode sheet (order_id barcode + child name per cell) for a
+    list of order_ids, or for a printer's orders sent to print in a date range.
+
+    Pages are rendered in parallel in the barcode process pool. PDF output is
+    merged into a temp file and streamed back; PNG output is a single page,
+    with the page count in X-Sheet-Pages.
+
+    A printer token only ever gets its own printer's orders: `printer` is
+    forced to the token's printer, and order_ids belonging to another printer
+    are dropped as if they did not exist.
+    """
+    role, token_printer = _token_access(token)
+    if role != "admin":
+        printer = token_printer
+
+    fmt = fmt.lower()
+    if fmt not in ("pdf", "png"):
+        raise HTTPException(status_code=400, detail="fmt must be pdf or png")
+
+    projection = {"order_id": 1, "name": 1}
+    if order_ids:
+        wanted = list(dict.fromkeys(oid for oid in order_ids if oid and oid.strip()))
+        id_query: Dict[str, Any] = {"order_id": {"$in": wanted}}
+        if role != "admin":
+            id_query = {"$and": [id_query, printer_filter(printer)]}
+        docs = await asyncio.to_thread(lambda: list(orders_collection.find(id_query, projection)))
+        names = {d["order_id"]: d.get("name") or "" for d in docs}
+        if role != "admin":
+            wanted = [oid for oid in wanted if oid in names]
+        entries = [(oid, names.get(oid, "")) for oid in wanted]
+    elif printer or date_from or date_to:
+        if not (date_from or date_to):
+            raise HTTPException(status_code=400, detail="date_from or date_to required with printer")
+        query: Dict[str, Any] = {"paid": True, "is_test": NOT_TEST, **_print_sent_range(date_from, date_to)}
+        if printer:
+            query = {"$and": [query, printer_filter(printer)]}
+        docs = await asyncio.to_thread(
+            lambda: list(orders_collection.find(query, projection)
+                         .sort([("print_sent_at", 1), ("_id", 1)]).limit(BARCODE_SHEET_MAX + 1))
+        )
+        entries = [(d["order_id"], d.get("name") or "") for d in docs if d.get("order_id")]
+    else:
+        raise HTTPException(status_code=400, detail="order_ids, or printer with a date range, required")
+
+    if not entries:
+        raise HTTPException(status_code=404, detail="No orders matched")
+    if len(entries) > BARCODE_SHEET_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {BARCODE_SHEET_MAX} orders per sheet")
+
+    per_page = BARCODE_SHEET_COLS * BARCODE_SHEET_ROWS
+    chunks = [entries[i:i + per_page] for i in range(0, len(entries), per_page)]
+    stamp = f"{datetime.utcnow():%Y%m%d_%H%M%S}"
+    loop = asyncio.get_running_loop()
+    pool = _barcode_executor()
+
+    try:
+        if fmt == "png":
+            if page > len(chunks):
+                raise HTTPException(status_code=404, detail=f"sheet has {len(chunks)} pages")
+            data = await loop.run_in_executor(pool, _render_barcode_sheet_page, chunks[page - 1], fmt)
+            return Response(
+                content=data,
+                media_type="image/png",
+                headers={
+                    "Content-Disposition": f'inline; filename="barcodes_{stamp}_p{page}.png"',
+                    "X-Sheet-Pages": str(len(chunks)),
+                },
+            )
+
+        pages = await asyncio.gather(
+            *(loop.run_in_executor(pool, _render_barcode_sheet_page, chunk, fmt) for chunk in chunks)
+        )
+    except barcode_errors.BarcodeError as e:
+        raise HTTPException(status_code=400, detail=f"cannot encode barcode: {e}")
+
+    merged_path = await asyncio.to_thread(_merge_pdf_pages, pages)
+    return FileResponse(
+        merged_path,
+        media_type="application/pdf",
+        background=BackgroundTask(os.unlink, merged_path),
+        headers={
+            "Content-Disposition": f'attachment; filename="barcodes_{stamp}.pdf"',
+            "X-Sheet-Pages": str(len(chunks)),
+            "X-Sheet-Orders": str(len(entries)),
+        },
+    )
+
+
+# -----------------------------------------------------------------------------
+# Label prefetcher: create + AWB + label before the order reaches the station
+# -----------------------------------------------------------------------------
+SR_PREFETCH_ENABLED = os.getenv("SHIPROCKET_PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+SR_PREFETCH_WORKERS = int(os.getenv("SHIPROCKET_PREFETCH_WORKERS", "4"))
+SR_PREFETCH_SWEEP_SECONDS = float(os.getenv("SHIPROCKET_PREFETCH_SWEEP_SECONDS", "300"))
+SR_PREFETCH_SWEEP_LIMIT = int(os.getenv("SHIPROCKET_PREFETCH_SWEEP_LIMIT", "200"))
+SR_PREFETCH_MAX_ATTEMPTS = int(os.getenv("SHIPROCKET_PREFETCH_MAX_ATTEMPTS", "3"))
+SR_PREFETCH_MAX_AGE_DAYS = float(os.getenv("SHIPROCKET_PREFETCH_MAX_AGE_DAYS", "3"))
+SR_PREFETCH_CLAIM_SECONDS = float(os.getenv("SHIPROCKET_PREFETCH_CLAIM_SECONDS", "120"))
+
+_prefetch_queue: Optional[asyncio.Queue] = None
+_prefetch_queued: set = set()
+_prefetch_inflight: Dict[str, asyncio.Task] = {}
+_prefetch_tasks: List[asyncio.Task] = []
+
+
+def _prefetch_candidates_query() -> Dict[str, Any]:
+    """
+    Orders sent to print in the last SR_PREFETCH_MAX_AGE_DAYS with no label
+    yet. Older ones are backlog nobody is about to pack; they get their label
+    at the scan, like before.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=SR_PREFETCH_MAX_AGE_DAYS)
+    return {
+        "paid": True,
+        "is_test": False,
+        "label_url": {"$in": [None, ""]},
+        # print_sent_at is a datetime on most docs but an ISO string on some
+        "$or": [
+            {"print_sent_at": {"$gte": cutoff}},
+            {"print_sent_at": {"$gte": cutoff.strftime("%Y-%m-%dT%H:%M:%S")}},
+        ],
+        "label_prefetch_attempts": {"$not": {"$gte": SR_PREFETCH_MAX_ATTEMPTS}},
+    }
+
+
+def _claim_label_order(order_id: str) -> Optional[Tuple[Dict[str, Any], str]]:
+    """
+    Atomically take the right to create this order's shipment, so prefetchers
+    and scans in other processes never create it twice. The claim is a lease:
+    a holder that dies just lets it lapse. Returns (doc, token) or None when
+    the order is labelled or someone else holds the claim.
+    """
+    now = datetime.now(timezone.utc)
+    token = uuid.uuid4().hex
+    doc = orders_collection.find_one_and_update(
+        {"order_id": order_id, "label_url": {"$in": [None, ""]}, "$or": [
+            {"prefetch_claim_until": {"$exists": False}},
+            {"prefetch_claim_until": {"$lt": now}},
+        ]},
+        {"$set": {"prefetch_claim": token,
+                  "prefetch_claim_until": now + timedelta(seconds=SR_PREFETCH_CLAIM_SECONDS)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    return (doc, token) if doc else None
+
+
+def _release_label_claim(doc_id: Any, token: str) -> None:
+    orders_collection.update_one(
+        {"_id": doc_id, "prefetch_claim": token},
+        {"$unset": {"prefetch_claim": "", "prefetch_claim_until": ""}},
+    )
+
+
+def _renew_label_claims(tokens: List[str]) -> None:
+    """Push the lease of claims held across a long multi-stage call."""
+    if tokens:
+        orders_collection.update_many(
+            {"prefetch_claim": {"$in": tokens}},
+            {"$set": {"prefetch_claim_until": datetime.now(timezone.utc) + timedelta(seconds=SR_PREFETCH_CLAIM_SECONDS)}},
+        )
+
+
+async def _wait_label_claim(order_id: str) -> None:
+    """Wait (at most one lease) for another process's claim on the order to go."""
+    deadline = time.monotonic() + SR_PREFETCH_CLAIM_SECONDS
+    while time.monotonic() < deadline:
+        held = await asyncio.to_thread(
+            orders_collection.find_one,
+            {"order_id": order_id, "label_url": {"$in": [None, ""]},
+             "prefetch_claim_until": {"$gte": datetime.now(timezone.utc)}},
+            {"_id": 1},
+        )
+        if not held:
+            return
+        await asyncio.sleep(0.25)
+
+
+def enqueue_label_prefetch(order_id: str) -> bool:
+    """
+    Queue an order for label warm-up. Call from the event loop (async
+    handlers); no-op when prefetching is disabled or the order is queued.
+    """
+    if not SR_PREFETCH_ENABLED or _prefetch_queue is None or not order_id:
+        return False
+    if order_id in _prefetch_queued or order_id in _prefetch_inflight:
+        return False
+    _prefetch_queued.add(order_id)
+    _prefetch_queue.put_nowait(order_id)
+    return True
+
+
+async def _prefetch_label(order_id: str) -> None:
+    claimed = await asyncio.to_thread(_claim_label_order, order_id)
+    if not claimed:
+        return
+    doc, token = claimed
+    try:
+        if not doc.get("paid") or doc.get("is_test"):
+            return
+        headers = _sr_headers(await asyncio.to_thread(_sr_login_token))
+        result = await _scan_generate_label(doc, headers)
+    finally:
+        await asyncio.to_thread(_release_label_claim, doc["_id"], token)
+
+    fields: Dict[str, Any] = {"label_prefetch_error": "; ".join(result["errors"]) or None}
+    if doc.get("label_url"):
+        fields["label_prefetched_at"] = datetime.utcnow().isoformat()
+        try:
+            await cache_label_pdf(doc)
+        except Exception as e:
+            print(f"[PREFETCH] {order_id}: label PDF not cached: {e}")
+    await asyncio.to_thread(
+        orders_collection.update_one,
+        {"_id": doc["_id"]},
+        {"$set": fields, "$inc": {"label_prefetch_attempts": 1}},
+    )
+    if result["errors"]:
+        print(f"[PREFETCH] {order_id}: {result['errors']}")
+
+
+async def _prefetch_worker() -> None:
+    while True:
+        order_id = await _prefetch_queue.get()
+        _prefetch_queued.discard(order_id)
+        task = asyncio.create_task(_prefetch_label(order_id))
+        _prefetch_inflight[order_id] = task
+        try:
+            await task
+        except Exception as e:
+            print(f"[PREFETCH] {order_id} failed: {e}")
+        finally:
+            _prefetch_inflight.pop(order_id, None)
+            _prefetch_queue.task_done()
+
+
+async def _prefetch_sweeper() -> None:
+    # print_sent_at is set outside this service, so poll for new candidates
+    while True:
+        try:
+            docs = await asyncio.to_thread(
+                lambda: list(orders_collection.find(_prefetch_candidates_query(), {"order_id": 1})
+                             .sort("print_sent_at", -1).limit(SR_PREFETCH_SWEEP_LIMIT))
+            )
+            queued = sum(enqueue_label_prefetch(d["order_id"]) for d in docs if d.get("order_id"))
+            if queued:
+                print(f"[PREFETCH] sweep queued {queued} orders")
+        except Exception as e:
+            print(f"[PREFETCH] sweep error: {e}")
+        await asyncio.sleep(SR_PREFETCH_SWEEP_SECONDS)
+
+
+@app.on_event("startup")
+async def _start_label_prefetcher() -> None:
+    global _prefetch_queue
+    if not SR_PREFETCH_ENABLED:
+        return
+    _prefetch_queue = asyncio.Queue()
+    for _ in range(SR_PREFETCH_WORKERS):
+        _prefetch_tasks.append(asyncio.create_task(_prefetch_worker()))
+    _prefetch_tasks.append(asyncio.create_task(_prefetch_sweeper()))
+
+
+@app.on_event("shutdown")
+async def _stop_label_prefetcher() -> None:
+    for task in _prefetch_tasks:
+        task.cancel()
+
+
+def _label_path(order_id: str) -> str:
+    # the cached, token-checked copy of the label (GET /shiprocket/labels/{order_id})
+    return f"/shiprocket/labels/{quote(order_id, safe='')}"
+
+
 @app.post("/scan-order")
-def scan_order(order_id: str = Body(..., embed=True)):
-    doc = orders_collection.find_one({"order_id": order_id})
+async def scan_order(order_id: str = Body(..., embed=True)):
+    """
+    Label station endpoint: return the order's label URL as fast as possible.
+
+    Pre-warmed orders (see the label prefetcher) are a DB read plus a pickup
+    enqueue. Otherwise the order goes through create → AWB → label only; the
+    pickup is queued on the pickup coalescer and requested with the rest of its
+    location's batch. Latencies feed the p50/p99 in /shiprocket/metrics.
+    """
+    t0 = time.perf_counter()
+    try:
+        return await _scan_order(order_id, t0)
+    finally:
+        # errors and timeouts count too, so slow failures show up in p99
+        _scan_latencies_ms.append((time.perf_counter() - t0) * 1000)
+
+
+async def _scan_order(order_id: str, t0: float) -> Dict[str, Any]:
+    # a prefetch already talking to Shiprocket for this order: wait, don't duplicate
+    inflight = _prefetch_inflight.get(order_id)
+    if inflight is not None:
+        await asyncio.wait([inflight])
+
+    doc = await asyncio.to_thread(orders_collection.find_one, {"order_id": order_id})
     if not doc:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    # Safety: if label already exists, just return it
+    claimed = None
+    if not doc.get("label_url"):
+        claimed = await asyncio.to_thread(_claim_label_order, order_id)
+        if not claimed:
+            # a prefetcher in another process is creating it right now
+            await _wait_label_claim(order_id)
+            claimed = await asyncio.to_thread(_claim_label_order, order_id)
+        if claimed:
+            doc = claimed[0]
+        else:
+            doc = await asyncio.to_thread(orders_collection.find_one, {"order_id": order_id}) or doc
+
     if doc.get("label_url"):
-        return {
+        resp: Dict[str, Any] = {
             "status": "already_processed",
             "order_id": order_id,
             "label_url": doc["label_url"],
+            "label_path": _label_path(order_id),
         }
+        # prefetched labels skip pickup; the scan is what says the parcel is packed
+        if doc.get("label_prefetched_at") and doc.get("sr_shipment_id") \
+                and not doc.get("pickup_requested") and not doc.get("pickup_pending"):
+            await enqueue_pickup(_sid_key(doc["sr_shipment_id"]), doc.get("shiprocket_pickup_location"))
+            resp["status"] = "prefetched"
+            resp["pickup"] = {"queued": True, "window_seconds": PICKUP_BATCH_WINDOW_SECONDS}
+        return resp
 
-    # Call your EXISTING Shiprocket flow
-    result = shiprocket_create_from_orders(
-        order_ids=[order_id],
-        assign_awb=True,
-        request_pickup=True,
-        generate_label=True,
-    )
-
-    # Fetch updated doc (label_url is set inside that function)
-    updated = orders_collection.find_one({"order_id": order_id})
-
+    try:
+        headers = _sr_headers(await asyncio.to_thread(_sr_login_token))
+        result = await _scan_generate_label(doc, headers)
+    finally:
+        if claimed:
+            await asyncio.to_thread(_release_label_claim, doc["_id"], claimed[1])
+
+    if doc.get("label_url") and doc.get("sr_shipment_id") and not doc.get("pickup_requested"):
+        await enqueue_pickup(_sid_key(doc["sr_shipment_id"]), doc.get("shiprocket_pickup_location"))
+        result["pickup"] = {"queued": True, "window_seconds": PICKUP_BATCH_WINDOW_SECONDS}
+    invalidate_orders_count_cache()
+
+    latency_ms = (time.perf_counter() - t0) * 1000
     return {
         "status": "processed",
         "order_id": order_id,
-        "label_url": updated.get("label_url"),
+        "label_url": doc.get("label_url"),
+        "label_path": _label_path(order_id) if doc.get("label_url") else None,
+        "latency_ms": round(latency_ms, 1),
         "shiprocket_response": result,
     }
 
+
+if __name__ == "__main__":
+    import argparse
+
+    cli = argparse.ArgumentParser(description="Maintenance commands for the printers backend")
+    cli.add_argument("command", choices=["backfill-order-keys", "migrate-shipment-ids", "precompute-sr-payloads"])
+    args = cli.parse_args()
+
+    if args.command == "backfill-order-keys":
+        _ensure_order_indexes()
+        print(f"stamped normalized order keys on {backfill_order_keys()} documents")
+
+    if args.command == "migrate-shipment-ids":
+        _ensure_order_indexes()
+        print(f"converted sr_shipment_id to int on {migrate_shipment_ids()} documents")
+
+    if args.command == "precompute-sr-payloads":
+        _ensure_order_indexes()
+        total = {"processed": 0, "invalid": 0}
+        while True:
+            res = precompute_sr_payloads()
+            if not res["processed"]:
+                break
+            total = {k: total[k] + res[k] for k in total}
+        print(f"precomputed {total['processed']} Shiprocket payloads ({total['invalid']} invalid)")
@@ -0,0 +1,21 @@
+# Integration tests: they talk to a real, disposable MongoDB (MONGO_TEST_URI)
+# and fake only the Shiprocket / Razorpay HTTP calls.
+import asyncio
+import os
+import sys
+
+import pytest
+
+MONGO_TEST_URI = os.getenv("MONGO_TEST_URI")
+if not MONGO_TEST_URI:
+    collect_ignore_glob = ["test_*.py"]
+else:
+    os.environ["MONGO_URI"] = MONGO_TEST_URI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine to completion on a fresh event loop."""
+    return asyncio.run
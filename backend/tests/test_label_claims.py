@@ -0,0 +1,66 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def order():
+    oid = f"TEST#claim-{uuid.uuid4().hex[:8]}"
+    main.orders_collection.insert_one({
+        "order_id": oid,
+        "paid": True,
+        "is_test": False,
+        "label_url": None,
+        "sr_payload": {"order_id": oid, "pickup_location": "Primary"},
+        "sr_payload_errors": [],
+    })
+    yield oid
+    main.orders_collection.delete_many({"order_id": oid})
+
+
+@pytest.fixture
+def shiprocket(monkeypatch):
+    """Fake Shiprocket: counts create calls; each call takes a moment."""
+    calls = {"create": 0}
+
+    async def _sr_call(method, path, *, headers, stage, json=None, timeout=30.0):
+        await asyncio.sleep(0.05)
+        req = httpx.Request(method, f"https://sr.test{path}")
+        if stage == "create":
+            calls["create"] += 1
+            return httpx.Response(200, json={"order_id": 1, "shipment_id": 1000 + calls["create"]}, request=req)
+        if stage == "awb":
+            return httpx.Response(200, json={"awb_code": "AWB1", "courier_company_id": 1}, request=req)
+        return httpx.Response(200, json={"label_url": "https://sr.test/label.pdf"}, request=req)
+
+    async def _cache_label_pdf(doc):
+        return None
+
+    monkeypatch.setattr(main, "_sr_call", _sr_call)
+    monkeypatch.setattr(main, "_sr_login_token", lambda *a, **k: "token")
+    monkeypatch.setattr(main, "sr_payload_for", lambda doc: (
+        {"sr_payload": doc["sr_payload"], "sr_payload_errors": []}, False))
+    monkeypatch.setattr(main, "cache_label_pdf", _cache_label_pdf)
+    return calls
+
+
+def test_prefetch_and_create_from_orders_create_once(order, shiprocket, run):
+    async def _both():
+        return await asyncio.gather(
+            main._prefetch_label(order),
+            main.shiprocket_create_from_orders(
+                order_ids=[order], assign_awb=True, request_pickup=False, generate_label=True,
+                defer_pickup=False, label_batch_size=1, dry_run=False,
+            ),
+        )
+
+    run(_both())
+
+    assert shiprocket["create"] == 1
+    doc = main.orders_collection.find_one({"order_id": order})
+    assert doc["sr_shipment_id"] == 1001
+    assert "prefetch_claim" not in doc
@@ -0,0 +1,30 @@
+import uuid
+
+import pytest
+
+from app.routers import reconcile
+
+
+@pytest.fixture
+def order():
+    oid = f"TEST#tx-{uuid.uuid4().hex[:8]}"
+    reconcile.orders_collection.insert_one({"order_id": oid, "transaction_id": "pay_Old1"})
+    yield oid
+    reconcile.orders_collection.delete_many({"order_id": oid})
+    reconcile.payment_matches_collection.delete_many({"order_id": oid})
+
+
+def test_changed_transaction_id_is_restamped_and_matched(order, monkeypatch):
+    reconcile._stamp_transaction_id_norm(force=True)
+    assert reconcile.orders_collection.find_one({"order_id": order})["transaction_id_norm"] == "pay_old1"
+
+    # corrected after the first stamp, with the formatting only the norm absorbs
+    reconcile.orders_collection.update_one(
+        {"order_id": order}, {"$set": {"transaction_id": " PAY_New2 "}}
+    )
+    monkeypatch.setattr(reconcile, "_tx_norm_swept_at", 0.0)
+
+    res = reconcile.match_payments_to_orders(["pay_new2"], case_insensitive=True)
+
+    assert res["matches"]["pay_new2"]["order_id"] == order
+    assert reconcile.orders_collection.find_one({"order_id": order})["transaction_id_norm"] == "pay_new2"
@@ -2,6 +2,7 @@
 
 import { useEffect, useState, useCallback } from "react";
 import { motion, AnimatePresence } from "framer-motion";
+import { pollSyncJob } from "./syncJob";
 
 type RawOrder = {
   order_id: string;
@@ -66,6 +67,7 @@ export default function GenesisShipDashboard({
   const [loading, setLoading] = useState(false);
   const [isShipping, setIsShipping] = useState(false);
   const [isSyncing, setIsSyncing] = useState(false);
+  const [isPrinting, setIsPrinting] = useState(false);
 
   const [currentPage, setCurrentPage] = useState(1);
   const pageSize = 18;
@@ -76,7 +78,17 @@ export default function GenesisShipDashboard({
   const [searchInput, setSearchInput] = useState("");
   const [searchText, setSearchText] = useState("");
 
-  const isMutating = isShipping || isSyncing;
+  // labels are token-protected; the token comes from the URL, as on the main dashboard
+  const [token, setToken] = useState("");
+  useEffect(() => {
+    try {
+      setToken(new URLSearchParams(window.location.search).get("token") || "");
+    } catch {
+      // ignore
+    }
+  }, []);
+
+  const isMutating = isShipping || isSyncing || isPrinting;
 
   const fetchGenesisOrders = useCallback(
     async (page = 1, search = "") => {
@@ -322,6 +334,36 @@ export default function GenesisShipDashboard({
     }
   };
 
+  const printLabels = async () => {
+    if (selected.size === 0 || isMutating) return;
+
+    setIsPrinting(true);
+    try {
+      const res = await fetch(`${baseUrl}/shiprocket/labels/merged`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ order_ids: Array.from(selected), token }),
+      });
+      if (!res.ok) {
+        let msg = `HTTP ${res.status}`;
+        try {
+          const j = await res.json();
+          msg = j.detail || JSON.stringify(j);
+        } catch {}
+        throw new Error(msg);
+      }
+
+      const missing = res.headers.get("X-Labels-Missing");
+      const blob = await res.blob();
+      window.open(URL.createObjectURL(blob), "_blank");
+      if (missing) alert(`No label for: ${missing}`);
+    } catch (err: any) {
+      alert("Print labels failed: " + err?.message);
+    } finally {
+      setIsPrinting(false);
+    }
+  };
+
   const syncOrders = async () => {
     if (isMutating) return;
 
@@ -344,13 +386,18 @@ export default function GenesisShipDashboard({
         console.warn("sync: could not parse JSON", e);
       }
 
-      console.log("SYNC RESULT:", res.status, j);
-
       if (!res.ok) {
         const msg = (j && (j.detail || j.message)) || `HTTP ${res.status}`;
         throw new Error(msg);
       }
 
+      // the backend queues a job; poll it until it finishes
+      if (j.job_id) {
+        j = await pollSyncJob(baseUrl, j.job_id);
+      }
+
+      console.log("SYNC RESULT:", j);
+
       const matched = j.matched_docs ?? 0;
       const eligible =
         j.eligible_count ?? (j.eligible_shipments?.length ?? 0);
@@ -455,6 +502,20 @@ export default function GenesisShipDashboard({
                   "Sync Orders"
                 )}
               </motion.button>
+
+              <motion.button
+                whileHover={{ scale: selected.size > 0 && !isMutating ? 1.02 : 1 }}
+                whileTap={{ scale: selected.size > 0 && !isMutating ? 0.98 : 1 }}
+                onClick={printLabels}
+                disabled={selected.size === 0 || isMutating}
+                className={`px-6 py-3 rounded-xl text-sm font-semibold transition-all duration-200 ${
+                  selected.size === 0 || isMutating
+                    ? "bg-gray-100 text-gray-400 cursor-not-allowed"
+                    : "bg-gradient-to-r from-purple-600 to-purple-700 text-white shadow-lg hover:shadow-xl"
+                }`}
+              >
+                {isPrinting ? "Merging..." : "Print Labels"}
+              </motion.button>
             </div>
 
             <motion.div
@@ -587,7 +648,7 @@ export default function GenesisShipDashboard({
                           <motion.a
                             whileHover={{ scale: 1.05 }}
                             whileTap={{ scale: 0.95 }}
-                            href={o.label_url}
+                            href={`${baseUrl}/shiprocket/labels/${encodeURIComponent(o.order_id)}?token=${encodeURIComponent(token)}`}
                             target="_blank"
                             rel="noreferrer"
                             className="inline-flex items-center px-3 py-1.5 bg-purple-50 text-purple-600 rounded-lg hover:bg-purple-100 transition-colors duration-200 font-medium"
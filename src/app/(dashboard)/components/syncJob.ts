@@ -0,0 +1,18 @@
+// Polls a Shiprocket background job until it finishes; resolves with its result.
+export async function pollSyncJob(
+  baseUrl: string,
+  jobId: string,
+  intervalMs = 2000
+): Promise<any> {
+  for (;;) {
+    await new Promise((r) => setTimeout(r, intervalMs));
+    const res = await fetch(
+      `${baseUrl}/shiprocket/jobs/${encodeURIComponent(jobId)}`
+    );
+    if (!res.ok) throw new Error(`job status HTTP ${res.status}`);
+    const job = await res.json();
+    console.log("SYNC PROGRESS:", job.status, job.progress);
+    if (job.status === "done") return job.result ?? {};
+    if (job.status === "failed") throw new Error(job.error || "sync job failed");
+  }
+}
@@ -10,9 +10,16 @@ export default function ScanPage() {
   const [status, setStatus] = useState<string>("");
   const [labelUrl, setLabelUrl] = useState<string | null>(null);
   const [loading, setLoading] = useState(false);
+  // labels are served from the backend's label cache, which needs the dashboard token
+  const [token, setToken] = useState("");
 
   useEffect(() => {
     inputRef.current?.focus();
+    try {
+      setToken(new URLSearchParams(window.location.search).get("token") || "");
+    } catch {
+      // ignore
+    }
   }, []);
 
   async function generateLabel(id: string) {
@@ -36,12 +43,15 @@ export default function ScanPage() {
       const data = await res.json();
 
       if (data.label_url) {
+        const url = data.label_path
+          ? `${process.env.NEXT_PUBLIC_API_BASE_URL}${data.label_path}?token=${encodeURIComponent(token)}`
+          : data.label_url;
         setProcessedOrderId(id);
         setStatus(`✅ Shipping label for order ID "${id}" generated successfully`);
-        setLabelUrl(data.label_url);
+        setLabelUrl(url);
 
         // Auto-open PDF in new tab
-        window.open(data.label_url, "_blank");
+        window.open(url, "_blank");
       } else {
         setStatus(`⚠️ Unable to generate label for order ID "${id}"`);
       }
@@ -3,6 +3,7 @@
 import { useEffect, useState, useCallback } from "react";
 import { motion, AnimatePresence } from "framer-motion";
 import Sidebar from "./components/Sidebar";
+import { pollSyncJob } from "./components/syncJob";
 
 
 type RawOrder = {
@@ -430,6 +431,11 @@ export default function GenesisShipDashboard() {
         throw new Error(msg);
       }
 
+      // the backend queues a job; poll it until it finishes
+      if (j.job_id) {
+        j = await pollSyncJob(baseUrl, j.job_id);
+      }
+
       const matched = j.matched_docs ?? 0;
       const eligible =
         j.eligible_count ?? (j.eligible_shipments?.length ?? 0);
@@ -907,7 +913,7 @@ export default function GenesisShipDashboard() {
                           <td className="px-4 py-3">
                             {order.label_url ? (
                               <a
-                                href={order.label_url}
+                                href={`${baseUrl}/shiprocket/labels/${encodeURIComponent(order.order_id)}?token=${encodeURIComponent(token)}`}
                                 target="_blank"
                                 rel="noreferrer"
                                 download